@@ -4,6 +4,10 @@ from PIL import Image
 import numpy as np
 import os
 import imghdr
+import threading
+from collections import OrderedDict
+import datetime as dt
+from time import sleep
 
 
 def prepare_img_for_ocr(image):
@@ -32,6 +36,314 @@ def prepare_img_for_ocr(image):
     return img
 
 
+def prepare_img_for_ocr_fast(image, threshold=0.51, buffers=None):
+    """
+    Fast path of prepare_img_for_ocr with identical output, computed in one pass without the intermediate images:
+    one Otsu threshold (the 1x1 dilate/erode and the second threshold of convert_to_bw do not change a binary image),
+    the bounding box of the black pixels from row and column reductions instead of findContours, and the white
+    one pixel border with cv2.copyMakeBorder.
+
+    Parameters:
+    image: str or OpenCV/PIL Image
+        The input image, as for prepare_img_for_ocr.
+    threshold: float
+        Minimum ratio of white pixels for which the image is not inverted, as in convert_to_bw.
+    buffers: BufferLease, optional
+        Source of the intermediate images and of the white output image of a blank crop. Without it, they are newly
+        allocated. The cropped output image is always newly allocated: its size follows the text on the screen, so
+        pooling it would keep a buffer for every text size.
+
+    Returns:
+    img: OpenCV Image
+        The processed image ready for OCR.
+    """
+    img = load_image(image)
+    get_buffer = buffers.get if buffers is not None else (lambda shape: None)
+    height, width = img.shape[:2]
+    if len(img.shape) == 3:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=get_buffer((height, width)))
+        # The grayscale image is a private copy and can be thresholded in place
+        img_bw = gray
+    else:
+        gray = img
+        img_bw = get_buffer((height, width))
+    _, img_bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=img_bw)
+
+    # Ensure the background is white
+    if cv2.countNonZero(img_bw) / img_bw.size < threshold:
+        img_bw = cv2.bitwise_not(img_bw, dst=img_bw)
+
+    # Bounding box of the black pixels: rows and columns whose minimum is black
+    rows = np.flatnonzero(cv2.reduce(img_bw, 1, cv2.REDUCE_MIN).ravel() == 0)
+    cols = np.flatnonzero(cv2.reduce(img_bw, 0, cv2.REDUCE_MIN).ravel() == 0)
+    if rows.size == 0 or rows[-1] - rows[0] + 1 <= 2 or cols[-1] - cols[0] + 1 <= 2:
+        # No text or a crop of at most 2 pixels: a white image of the input size
+        img_bw.fill(255)
+        out = get_buffer((height + 2, width + 2))
+    else:
+        img_bw = img_bw[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+        out = None
+
+    return cv2.copyMakeBorder(img_bw, 1, 1, 1, 1, cv2.BORDER_CONSTANT, dst=out, value=255)
+
+
+def prepare_crops_for_ocr(image, rects, new_size=None, threshold=0.51, buffers=None, executor=None):
+    """
+    Crops many regions of one image and prepares each of them for OCR, with the same output as
+    prepare_img_for_ocr_fast per crop. Crops of equal shape are processed together: they are stacked, converted to
+    grayscale in one call, and inverted and reduced to their bounding boxes with array operations over the whole
+    stack; only the Otsu threshold and the border remain per crop. Crops of a shape of their own are prepared with
+    prepare_img_for_ocr_fast, on the executor if one is given.
+
+    Parameters:
+    image: str or OpenCV/PIL Image
+        The input image, as for prepare_img_for_ocr.
+    rects: list
+        The regions (x1, y1, x2, y2), in the coordinates of new_size if given, else of the image.
+    new_size: dict, optional
+        Size {"width": int, "height": int} the image is resized to before cropping (see resize_crop_cv2).
+    threshold: float
+        Minimum ratio of white pixels for which a crop is not inverted, as in convert_to_bw.
+    buffers: BufferLease, optional
+        Source of the intermediate images and of the white output images of blank crops, as in
+        prepare_img_for_ocr_fast. Without it, they are newly allocated.
+    executor: concurrent.futures.Executor, optional
+        Runs the crops of a shape of their own in parallel.
+
+    Returns:
+    list
+        The processed image of each region, in the order of rects; None for regions that are empty or could not
+        be cropped.
+    """
+    img = load_image(image)
+    if new_size is not None and not is_downscaling(img, new_size):
+        # resize_crop_cv2 would resize the full image for every crop, resize it once instead
+        img = cv2.resize(img, (new_size["width"], new_size["height"]))
+        new_size = None
+    crops = []
+    for x1, y1, x2, y2 in rects:
+        if new_size is not None:
+            crops.append(resize_crop_cv2(img, new_size, x1, y1, x2, y2))
+        else:
+            crops.append(img[y1:y2, x1:x2])
+
+    # Group the crops by shape
+    shape_groups = {}
+    for index, crop in enumerate(crops):
+        if crop is not None and crop.size > 0:
+            shape_groups.setdefault(crop.shape, []).append(index)
+
+    filtered_crops = [None] * len(crops)
+    single_indices = []
+    for indices in shape_groups.values():
+        if len(indices) == 1:
+            single_indices.append(indices[0])
+            continue
+        group_crops = prepare_crop_group([crops[index] for index in indices], threshold, buffers)
+        for index, filtered_crop in zip(indices, group_crops):
+            filtered_crops[index] = filtered_crop
+
+    def prepare_single(index):
+        return prepare_img_for_ocr_fast(crops[index], threshold, buffers)
+
+    if executor is not None and len(single_indices) > 1:
+        single_crops = executor.map(prepare_single, single_indices)
+    else:
+        single_crops = map(prepare_single, single_indices)
+    for index, filtered_crop in zip(single_indices, single_crops):
+        filtered_crops[index] = filtered_crop
+    return filtered_crops
+
+
+def prepare_crop_group(crops, threshold=0.51, buffers=None):
+    """
+    Prepares crops of equal shape for OCR as one stack (see prepare_crops_for_ocr).
+
+    Returns:
+    list
+        The processed image of each crop.
+    """
+    get_buffer = buffers.get if buffers is not None else (lambda shape: None)
+    count = len(crops)
+    height, width = crops[0].shape[:2]
+
+    # Grayscale stack of all crops, one image below the other for cvtColor
+    stack = get_buffer((count, height, width))
+    if stack is None:
+        stack = np.empty((count, height, width), dtype=np.uint8)
+    if len(crops[0].shape) == 3:
+        color_stack = np.stack(crops).reshape(count * height, width, crops[0].shape[2])
+        cv2.cvtColor(color_stack, cv2.COLOR_BGR2GRAY, dst=stack.reshape(count * height, width))
+    else:
+        np.stack(crops, out=stack)
+
+    # Otsu needs the histogram of each crop
+    for crop_bw in stack:
+        cv2.threshold(crop_bw, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=crop_bw)
+
+    # Ensure the background is white
+    white_ratios = np.count_nonzero(stack.reshape(count, -1), axis=1) / (height * width)
+    invert = white_ratios < threshold
+    if invert.any():
+        np.bitwise_not(stack, out=stack, where=invert[:, None, None])
+
+    # Bounding boxes of the black pixels: rows and columns whose minimum is black
+    black_rows = stack.min(axis=2) == 0
+    black_cols = stack.min(axis=1) == 0
+    has_text = black_rows.any(axis=1)
+    top = black_rows.argmax(axis=1)
+    bottom = height - black_rows[:, ::-1].argmax(axis=1)
+    left = black_cols.argmax(axis=1)
+    right = width - black_cols[:, ::-1].argmax(axis=1)
+    is_blank = ~has_text | (bottom - top <= 2) | (right - left <= 2)
+
+    filtered_crops = []
+    for index, crop_bw in enumerate(stack):
+        if is_blank[index]:
+            # No text or a crop of at most 2 pixels: a white image of the input size
+            out = get_buffer((height + 2, width + 2))
+            if out is None:
+                out = np.empty((height + 2, width + 2), dtype=np.uint8)
+            out.fill(255)
+            filtered_crops.append(out)
+            continue
+        # The size of the cropped output follows the text, so it is not taken from the buffers
+        crop_bw = crop_bw[top[index]:bottom[index], left[index]:right[index]]
+        filtered_crops.append(cv2.copyMakeBorder(crop_bw, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=255))
+    return filtered_crops
+
+
+class BufferPool:
+    """
+    Pool of reusable image buffers, keyed by shape and dtype, so preprocessing in a hot loop does not allocate new
+    arrays for every frame. Buffers are taken through a BufferLease and returned all at once when the lease is
+    released. Thread-safe.
+    """
+    def __init__(self, max_free_per_shape=8):
+        """
+        Args:
+            max_free_per_shape (int): Released buffers kept per shape; more are left to the garbage collector.
+        """
+        self.max_free_per_shape = max_free_per_shape
+        self.free_buffers = {}
+        self.stats = {"allocations": 0, "reuses": 0}
+        self._lock = threading.Lock()
+
+    def acquire(self, shape, dtype=np.uint8):
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            free_buffers = self.free_buffers.get(key)
+            if free_buffers:
+                self.stats["reuses"] += 1
+                return free_buffers.pop()
+            self.stats["allocations"] += 1
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buffer):
+        key = (buffer.shape, buffer.dtype.str)
+        with self._lock:
+            free_buffers = self.free_buffers.setdefault(key, [])
+            if len(free_buffers) < self.max_free_per_shape:
+                free_buffers.append(buffer)
+
+    def lease(self):
+        return BufferLease(self)
+
+
+class BufferLease:
+    """
+    Buffers taken from a BufferPool for one unit of work, e.g. one frame. The buffers must not be used after release.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffers = []
+
+    def get(self, shape, dtype=np.uint8):
+        buffer = self.pool.acquire(shape, dtype)
+        self.buffers.append(buffer)
+        return buffer
+
+    def release(self):
+        buffers, self.buffers = self.buffers, []
+        for buffer in buffers:
+            self.pool.release(buffer)
+
+
+class DecodedImageCache:
+    """
+    LRU cache of decoded image files, keyed by path and (modification time, file size), so an image shown in the
+    UI and matched by the ImageMatcher is decoded only once. A rewritten file is decoded again. Thread-safe.
+
+    The cached images are shared by all callers and must not be modified: the arrays are read-only, PIL images
+    must be copied before drawing on them.
+    """
+    def __init__(self, max_entries=4):
+        """
+        Args:
+            max_entries (int): Number of decoded images kept; the least recently used one is dropped first.
+        """
+        self.max_entries = max_entries
+        # {path: {"stamp": (mtime_ns, size), "array": ndarray, "pil_image": PIL.Image.Image or None}}
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "decodes": 0, "evictions": 0}
+        self._lock = threading.Lock()
+
+    def get_entry(self, path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry["stamp"] == stamp:
+                self.entries.move_to_end(path)
+                self.stats["hits"] += 1
+                return entry
+
+        array = cv2.imread(path)
+        if array is None:
+            return None
+        array.flags.writeable = False
+        entry = {"stamp": stamp, "array": array, "pil_image": None}
+        with self._lock:
+            self.stats["decodes"] += 1
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return entry
+
+    def get_array(self, path):
+        """
+        Returns the decoded image (BGR, as cv2.imread) of a file, or None if it cannot be read.
+        """
+        entry = self.get_entry(path)
+        return None if entry is None else entry["array"]
+
+    def get_pil_image(self, path):
+        """
+        Returns the image of a file as an RGB PIL image, or None if it cannot be read. PIL keeps RGB pixels in its
+        own layout, so the image is converted from the cached array once and then reused.
+        """
+        entry = self.get_entry(path)
+        if entry is None:
+            return None
+        if entry["pil_image"] is None:
+            entry["pil_image"] = Image.fromarray(cv2.cvtColor(entry["array"], cv2.COLOR_BGR2RGB))
+        return entry["pil_image"]
+
+    def invalidate(self, path=None):
+        """
+        Drops the decoded image of a file, or all images if no path is given.
+        """
+        with self._lock:
+            if path is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(path, None)
+
  
  
 
@@ -234,13 +546,8 @@ def add_border_one_px(image, border_width=1):
     # Create a new canvas with white color
     new_width = width + 2 * border_width
     new_height = height + 2 * border_width
-
-    if channels == 1:
-        # For grayscale images
-        new_image = np.ones((new_height, new_width), dtype=np.uint8) * 255
-    else:
-        # For RGB images
-        new_image = np.ones((new_height, new_width, channels), dtype=np.uint8) * 255
+    new_shape = (new_height, new_width) if channels == 1 else (new_height, new_width, channels)
+    new_image = np.full(new_shape, 255, dtype=np.uint8)
 
     # Calculate position to paste the original image
     x_offset = border_width
@@ -477,18 +784,20 @@ def load_image(image):
         
     return image       
 
-def wait_for_first_image(capture):
+def wait_for_first_image(capture, poll_interval=0.1):
     """
-    Waits for the first captured image by continuously checking for the timestamp of the first image.
+    Waits for the first captured image by checking the timestamp of the first image every poll_interval seconds.
+    For watching a capture directory, see frame_stream.FrameStream.
 
     Args:
         capture (Capture): The Capture object responsible for image capture.
+        poll_interval (float): Seconds between two checks.
 
     Returns:
         str: The timestamp of the first captured image.
     """
     while capture.first_img_ts is None:
-        pass
+        sleep(poll_interval)
     #print('first_img_ts:   ', capture.first_img_ts)
     return capture.first_img_ts
    
@@ -518,7 +827,8 @@ def find_next_image(capture, first_img_ts,extract_parameters_from_img):
                 extract_parameters_from_img(current_img_ts, img_path)  # process the found image
                 
             img_ts += dt.timedelta(seconds=1)
-            sleep(0.1)
+        # Also wait while no newer image was captured, instead of re-checking the timestamp in a busy loop
+        sleep(0.1)
 
 def show_image(img):
 
@@ -533,12 +843,13 @@ def show_image(img):
     else:
         print("Error: Image not found.")
  
-def resize_image_cv2(input_image, new_size):  
+def resize_image_cv2(input_image, new_size, out=None):  
     """
     Resizes an input image using OpenCV.
          input_image (numpy.ndarray): The original image to be resized.
         new_size (dict): A dictionary containing the target width and height.
             Example: {"width": 640, "height": 480}
+        out (numpy.ndarray, optional): Buffer of the target shape that receives the resized image.
 
     Returns:
         numpy.ndarray or None: The resized image if successful, or None if an error occurs.
@@ -558,7 +869,7 @@ def resize_image_cv2(input_image, new_size):
             return input_image
 
         # Resize the image
-        resized_image = cv2.resize(input_image, (target_width, target_height))
+        resized_image = cv2.resize(input_image, (target_width, target_height), dst=out)
 
         #print("Image resized successfully.")
         return resized_image
@@ -566,12 +877,80 @@ def resize_image_cv2(input_image, new_size):
         print(f"Error resizing image: {e}")
         return None
 
-def convert_to_grayscale(image):
+def is_downscaling(input_image, new_size):
+    """
+    Checks whether resizing the input image to new_size scales it down (or keeps its size) in both directions,
+    the case in which resize_crop_cv2 resamples only the crop.
+    """
+    original_height, original_width = input_image.shape[:2]
+    return new_size["width"] <= original_width and new_size["height"] <= original_height
+
+def resize_crop_cv2(input_image, new_size, x1, y1, x2, y2):
+    """
+    Returns the region [y1:y2, x1:x2] of the input image resized to new_size, without resizing the full image.
+    The rectangle is mapped from the target coordinates into the input image, only that region is cropped
+    (with a one pixel margin for the interpolation) and resampled with the same pixel mapping as cv2.resize.
+
+    warpAffine rounds the interpolation weights more coarsely than cv2.resize, so pixels can differ by one gray
+    level from the crop of the fully resized image. When scaling down this left the match scores of the templates
+    unchanged; when scaling up it moved feature scores by up to 0.03. Inputs smaller than new_size are therefore
+    resized fully and then cropped (see is_downscaling; callers with many crops resize such an input once).
+
+    Args:
+        input_image (numpy.ndarray): The original image.
+        new_size (dict): A dictionary containing the target width and height.
+            Example: {"width": 640, "height": 480}
+        x1, y1, x2, y2 (int): The rectangle in target coordinates.
+
+    Returns:
+        numpy.ndarray or None: The resized crop if successful, or None if an error occurs.
+    """
+    try:
+        original_height, original_width = input_image.shape[:2]
+        target_width = new_size["width"]
+        target_height = new_size["height"]
+
+        # Check if resizing is necessary
+        if (original_width, original_height) == (target_width, target_height):
+            return input_image[y1:y2, x1:x2]
+        if not is_downscaling(input_image, new_size):
+            return cv2.resize(input_image, (target_width, target_height))[y1:y2, x1:x2]
+
+        # Clip the rectangle to the target image the same way slicing the resized image would
+        x1, x2, _ = slice(x1, x2).indices(target_width)
+        y1, y2, _ = slice(y1, y2).indices(target_height)
+        crop_width, crop_height = max(x2 - x1, 0), max(y2 - y1, 0)
+        if crop_width == 0 or crop_height == 0:
+            return input_image[0:0, 0:0]
+
+        # Source position of the first target pixel, as computed by cv2.resize: (dst + 0.5) * scale - 0.5
+        scale_x = original_width / target_width
+        scale_y = original_height / target_height
+        src_x = (x1 + 0.5) * scale_x - 0.5
+        src_y = (y1 + 0.5) * scale_y - 0.5
+
+        # Crop the input region covering the rectangle plus the neighbours needed for the interpolation
+        roi_x1 = max(int(np.floor(src_x)), 0)
+        roi_y1 = max(int(np.floor(src_y)), 0)
+        roi_x2 = min(int(np.floor(src_x + (crop_width - 1) * scale_x)) + 2, original_width)
+        roi_y2 = min(int(np.floor(src_y + (crop_height - 1) * scale_y)) + 2, original_height)
+        roi = input_image[roi_y1:roi_y2, roi_x1:roi_x2]
+
+        # Resample only the cropped region; replicated borders reproduce the edge clamping of cv2.resize
+        transform = np.array([[scale_x, 0, src_x - roi_x1], [0, scale_y, src_y - roi_y1]], dtype=np.float64)
+        return cv2.warpAffine(roi, transform, (crop_width, crop_height),
+                              flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+    except Exception as e:
+        print(f"Error resizing image crop: {e}")
+        return None
+
+def convert_to_grayscale(image, out=None):
     """
     Converts an input color image to grayscale using OpenCV.
 
     Args:
         image (numpy.ndarray): The original color image (BGR format).
+        out (numpy.ndarray, optional): Buffer of the image's height and width that receives the grayscale image.
 
     Returns:
         numpy.ndarray or None: The grayscale image if successful, or None if an error occurs.
@@ -584,7 +963,7 @@ def convert_to_grayscale(image):
             return image
 
         # Convert the image to grayscale
-        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=out)
 
        # print("Image successfully converted to grayscale.")
         return gray_image
@@ -592,6 +971,27 @@ def convert_to_grayscale(image):
     except Exception as e:
         print(f"Error: {e}")
         return None
+
+def dhash_image(image, hash_size=16):
+    """
+    Computes the difference hash (dHash) of an image: the image is reduced to a grayscale grid of
+    hash_size x (hash_size + 1) pixels and every bit tells whether a pixel is brighter than its left neighbour.
+    Similar screens give hashes with a small Hamming distance, independent of the image resolution.
+
+    Args:
+        image (numpy.ndarray): The input image (BGR or grayscale).
+        hash_size (int): Number of rows and bits per row of the hash.
+
+    Returns:
+        numpy.ndarray or None: The hash bit-packed into hash_size * hash_size / 8 bytes, or None if an error occurs.
+    """
+    try:
+        gray_image = convert_to_grayscale(image)
+        small = cv2.resize(gray_image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+        return np.packbits(small[:, 1:] > small[:, :-1])
+    except Exception as e:
+        print(f"Error computing image hash: {e}")
+        return None
   
 def percentage_white_pixels(image):
     # In a binary image, white pixels have a value of 255
@@ -632,19 +1032,58 @@ def percentage_of_black_pixels(img):
     #print(f"Percentage of black pixels: {percentage_:.2f}%")
     return percentage_
 
-def is_no_signal(image):
+def is_no_signal(image, threshold=12.50, tolerance=0.5):
     """
     Determine if an image indicates a no signal state.
 
     Parameters:
     - image (ndarray): Input grayscale image.
+    - threshold (float): Percentage of black pixels of the no signal screen (one black bar of eight color bars).
+    - tolerance (float): Largest difference in percentage points from threshold, e.g. for the blurred bar edges
+      of a downsampled frame.
 
     Returns:
     - is_no_signal (bool): True if no signal, False otherwise.
     """
-    threshold=12.50
     percentage_black = percentage_of_black_pixels(image)
-    return percentage_black == threshold
+    return abs(percentage_black - threshold) <= tolerance
+
+
+def classify_blank_frame(image, sample_size=(160, 90), dark_level=24, black_ratio=0.98, uniform_ratio=0.98,
+                         bars_ratio=0.9, screensaver_ratio=0.9):
+    """
+    Cheap pre-classification of frames without screen content, from the gray histogram of a downsampled copy.
+
+    Parameters:
+    - image (ndarray): Input image (BGR or grayscale).
+    - sample_size (tuple): (width, height) of the downsampled copy.
+    - dark_level (int): Gray values below this level count as dark.
+    - black_ratio (float): Minimum ratio of dark pixels of a black frame.
+    - uniform_ratio (float): Minimum ratio of pixels in one histogram bin (of 32) of a single-colored no signal
+      screen.
+    - bars_ratio (float): Minimum ratio of pixels in eight histogram bins of a color bar no signal screen (see
+      is_no_signal); the edges of the bars are blurred by the downsampling.
+    - screensaver_ratio (float): Minimum ratio of dark pixels of a screensaver (a dark frame with little content).
+
+    Returns:
+    - str or None: "black", "no_signal" or "screensaver", or None for a frame with screen content.
+    """
+    if image is None or image.size == 0:
+        return None
+    sample = cv2.resize(image, sample_size, interpolation=cv2.INTER_LINEAR)
+    if len(sample.shape) == 3:
+        sample = cv2.cvtColor(sample, cv2.COLOR_BGR2GRAY)
+    histogram = np.bincount(sample.ravel(), minlength=256) / sample.size
+
+    dark_ratio = histogram[:dark_level].sum()
+    if dark_ratio >= black_ratio:
+        return "black"
+    bins = np.sort(histogram.reshape(32, 8).sum(axis=1))[::-1]
+    if bins[0] >= uniform_ratio or (bins[:8].sum() >= bars_ratio and is_no_signal(sample)):
+        return "no_signal"
+    if dark_ratio >= screensaver_ratio:
+        return "screensaver"
+    return None
  
 def crop_image(image, x1, x2, y1, y2):
     # Crop the image based on position coordinates
@@ -116,6 +116,7 @@ def main():
         config_file = config_manager.get_config('Paths', 'config_file')
         templates_dir = config_manager.get_config('Paths', 'templates_dir')
         choices_dict = config_manager.get_choices_dict()
+        matcher_settings = config_manager.get_matcher_settings()
         print("🔧 Paths and settings extracted successfully.")
     except Exception as e:
         print(f"❌ Error reading paths or choices configuration: {e}")
@@ -127,7 +128,8 @@ def main():
             mde_config_dir=config_files_dir,
             mde_config_file_name=config_file,
             templates_dir_name=templates_dir,
-            choices_dict=choices_dict
+            choices_dict=choices_dict,
+            matcher_settings=matcher_settings
         )
         print("🟢 Configuration Tool initialized successfully. Launching UI...")
         config_tool.mainloop()
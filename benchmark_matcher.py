@@ -0,0 +1,339 @@
+'''
+Benchmark for the ImageMatcher.
+
+Matches a set of frames against the templates in mde_config.json and reports the time per frame for the
+serial matcher, for the matcher that evaluates templates on a thread pool and for batched NCC scoring. By default the template images
+themselves, and copies of them scaled to 1920x1080, are used as input frames.
+
+The fused preprocessing (prepare_img_for_ocr_fast) is checked to give the same output as prepare_img_for_ocr on
+all feature and parameter crops of the templates, and both are timed, as is the batch preprocessing of all regions
+of a template in one call (prepare_crops_for_ocr). The allocations of the matcher's buffer pool
+are reported per frame on copies of the frames with shifted content, as is the blank frame check on the frames and on synthetic black, no signal and
+screensaver frames.
+
+With --calibrate-popcount the threshold of the popcount score engine is calibrated against the NCC score on the
+frames, and the popcount engine is benchmarked with it.
+
+Usage:
+    python benchmark_matcher.py [--workers 4] [--repeat 5] [--calibrate-popcount] [image_path ...]
+'''
+import argparse
+import contextlib
+import io
+import os
+import time
+
+import numpy as np
+from Image_functions_v001 import cv2, prepare_img_for_ocr, prepare_img_for_ocr_fast, prepare_crops_for_ocr
+from pattern_detection_v001 import ImageMatcher
+
+
+def load_frames(image_paths, templates_dir):
+    """
+    Loads the benchmark frames from the given image paths, or from the template images if no path is given.
+
+    Returns:
+    - list: (name, image) tuples.
+    """
+    if not image_paths:
+        image_paths = sorted(
+            os.path.join(templates_dir, file_name) for file_name in os.listdir(templates_dir)
+            if file_name.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp'))
+        )
+        scaled_copies = True
+    else:
+        scaled_copies = False
+
+    frames = []
+    for image_path in image_paths:
+        img = cv2.imread(image_path)
+        if img is None:
+            print(f"Failed to load image: {image_path}")
+            continue
+        frames.append((os.path.basename(image_path), img))
+        if scaled_copies:
+            frames.append((f"{os.path.basename(image_path)} (1920x1080)", cv2.resize(img, (1920, 1080))))
+    return frames
+
+
+def run_matcher(matcher, frames, repeat):
+    """
+    Matches all frames repeat times.
+
+    Returns:
+    - tuple: (milliseconds per frame, {frame name: (match_values, temp_img_id)})
+    """
+    results = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for name, img in frames:
+            # The matcher prints every match value, keep the benchmark output readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                results[name] = matcher.match_images(img)
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000 / (repeat * len(frames)), results
+
+
+def create_matcher(args, **matcher_settings):
+    # The matcher prints while it loads the templates
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ImageMatcher(args.config_dir, args.config_file, args.templates_dir, **matcher_settings)
+
+
+def load_template_regions(matcher):
+    """
+    Loads the template images with the feature and parameter regions of each.
+
+    Returns:
+    - list: (temp_img_id, image, [(name, (x1, y1, x2, y2)), ...]) tuples.
+    """
+    templates = []
+    for temp_img_id, temp_img_data in matcher.mde_config_data.get("images", {}).items():
+        temp_img = cv2.imread(os.path.join(matcher.templates_dir, temp_img_data.get("path", "")))
+        if temp_img is None:
+            continue
+        regions = []
+        for category in ("features", "parameters"):
+            for item_id, item in temp_img_data.get(category, {}).items():
+                position = item.get("position", {})
+                rect = (int(position.get("x1", 0)), int(position.get("y1", 0)),
+                        int(position.get("x2", 0)), int(position.get("y2", 0)))
+                regions.append((f"template {temp_img_id} {category[:-1]} {item_id}", rect))
+        templates.append((temp_img_id, temp_img, regions))
+    return templates
+
+
+def load_template_crops(templates):
+    """
+    Crops the feature and parameter regions of all templates from the template images.
+
+    Returns:
+    - list: (name, crop) tuples.
+    """
+    crops = []
+    for _, temp_img, regions in templates:
+        for name, (x1, y1, x2, y2) in regions:
+            crop = temp_img[y1:y2, x1:x2]
+            if crop.size:
+                crops.append((name, crop))
+    return crops
+
+
+def check_preprocessing(crops, repeat):
+    """
+    Checks that prepare_img_for_ocr_fast returns exactly the output of prepare_img_for_ocr and times both.
+    """
+    differences = [name for name, crop in crops
+                   if not np.array_equal(prepare_img_for_ocr(crop), prepare_img_for_ocr_fast(crop))]
+    timings = {}
+    for preprocess in (prepare_img_for_ocr, prepare_img_for_ocr_fast):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for _, crop in crops:
+                preprocess(crop)
+        timings[preprocess.__name__] = (time.perf_counter() - start) * 1e6 / (repeat * len(crops))
+    print(f"preprocessing ({len(crops)} template crops): prepare_img_for_ocr {timings['prepare_img_for_ocr']:.1f} us, "
+          f"fast path {timings['prepare_img_for_ocr_fast']:.1f} us per crop")
+    if differences:
+        print(f"Fast preprocessing differs for: {', '.join(differences)}")
+    else:
+        print("Fast preprocessing output is identical on all template crops")
+
+
+def check_batch_preprocessing(templates, repeat):
+    """
+    Checks that prepare_crops_for_ocr returns exactly the output of prepare_img_for_ocr_fast for all regions of a
+    template at once, and times both per crop.
+    """
+    differences = []
+    for _, temp_img, regions in templates:
+        filtered_crops = prepare_crops_for_ocr(temp_img, [rect for _, rect in regions])
+        for (name, (x1, y1, x2, y2)), filtered_crop in zip(regions, filtered_crops):
+            crop = temp_img[y1:y2, x1:x2]
+            expected = prepare_img_for_ocr_fast(crop) if crop.size else None
+            if (expected is None) != (filtered_crop is None) or (
+                    expected is not None and not np.array_equal(expected, filtered_crop)):
+                differences.append(name)
+
+    region_count = sum(len(regions) for _, _, regions in templates)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, temp_img, regions in templates:
+            prepare_crops_for_ocr(temp_img, [rect for _, rect in regions])
+    batch_us = (time.perf_counter() - start) * 1e6 / (repeat * region_count)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, temp_img, regions in templates:
+            for _, (x1, y1, x2, y2) in regions:
+                crop = temp_img[y1:y2, x1:x2]
+                if crop.size:
+                    prepare_img_for_ocr_fast(crop)
+    single_us = (time.perf_counter() - start) * 1e6 / (repeat * region_count)
+    print(f"batch preprocessing ({region_count} regions of {len(templates)} templates): {batch_us:.1f} us per crop, "
+          f"one crop at a time {single_us:.1f} us per crop")
+    if differences:
+        print(f"Batch preprocessing differs for: {', '.join(differences)}")
+    else:
+        print("Batch preprocessing output is identical on all template regions")
+
+
+def make_blank_frames():
+    """
+    Returns synthetic 1920x1080 blank frames: black, color bars of a no signal screen and a dark screensaver.
+
+    Returns:
+    - list: (name, image) tuples.
+    """
+    black = np.zeros((1080, 1920, 3), dtype=np.uint8)
+    color_bars = black.copy()
+    colors = [(255, 255, 255), (0, 255, 255), (255, 255, 0), (0, 255, 0), (255, 0, 255), (0, 0, 255), (255, 0, 0),
+              (0, 0, 0)]
+    for index, color in enumerate(colors):
+        color_bars[:, index * 240:(index + 1) * 240] = color
+    screensaver = black.copy()
+    cv2.putText(screensaver, "CNC", (760, 600), cv2.FONT_HERSHEY_SIMPLEX, 8, (255, 255, 255), 20)
+    return [("black", black), ("color bars", color_bars), ("screensaver", screensaver)]
+
+
+def make_shifted_frames(frames, count, max_shift=6, seed=0):
+    """
+    Returns copies of the frames with their content shifted by up to max_shift pixels in x and y, at the same frame
+    size, so the text bounding boxes of the feature crops change from frame to frame as on a live screen.
+
+    Returns:
+    - list: (name, image) tuples, count copies per frame.
+    """
+    rng = np.random.default_rng(seed)
+    shifted_frames = []
+    for _ in range(count):
+        for name, img in frames:
+            shift_x, shift_y = (int(shift) for shift in rng.integers(-max_shift, max_shift + 1, 2))
+            matrix = np.float32([[1, 0, shift_x], [0, 1, shift_y]])
+            shifted = cv2.warpAffine(img, matrix, (img.shape[1], img.shape[0]), borderMode=cv2.BORDER_REPLICATE)
+            shifted_frames.append((f"{name} ({shift_x:+d}, {shift_y:+d})", shifted))
+    return shifted_frames
+
+
+def report_mismatches(reference_results, results):
+    """
+    Prints the frames for which a matcher picked a different template than the reference (serial NCC) matcher.
+    """
+    mismatches = [name for name in reference_results if reference_results[name][1] != results[name][1]]
+    if mismatches:
+        print(f"Results differ from the serial matcher for: {', '.join(mismatches)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ImageMatcher.")
+    parser.add_argument("images", nargs="*", help="Input images. Defaults to the template images.")
+    parser.add_argument("--config-dir", default="ConfigFiles")
+    parser.add_argument("--config-file", default="mde_config.json")
+    parser.add_argument("--templates-dir", default="templates")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Threads for the concurrent matcher.")
+    parser.add_argument("--repeat", type=int, default=5, help="How often every frame is matched.")
+    parser.add_argument("--calibrate-popcount", action="store_true",
+                        help="Calibrate the popcount score engine against NCC and benchmark it.")
+    parser.add_argument("--hash-shortlist", type=int, default=3,
+                        help="Templates verified after the perceptual hash shortlist.")
+    args = parser.parse_args()
+
+    frames = load_frames(args.images, os.path.join(args.config_dir, args.templates_dir))
+    if not frames:
+        print("No frames to match.")
+        return
+
+    print(f"{len(frames)} frames, {args.repeat} repetitions, {os.cpu_count()} CPUs")
+
+    serial_matcher = create_matcher(args)
+    templates = load_template_regions(serial_matcher)
+    check_preprocessing(load_template_crops(templates), args.repeat)
+    check_batch_preprocessing(templates, args.repeat)
+
+    serial_ms, serial_results = run_matcher(serial_matcher, frames, args.repeat)
+    print(f"serial:              {serial_ms:8.2f} ms/frame")
+
+    threaded_matcher = create_matcher(args, max_workers=args.workers)
+    try:
+        threaded_ms, threaded_results = run_matcher(threaded_matcher, frames, args.repeat)
+    finally:
+        threaded_matcher.close()
+    print(f"thread pool ({args.workers:2d}):    {threaded_ms:8.2f} ms/frame   speedup x{serial_ms / threaded_ms:.2f}")
+
+    # The concurrent matcher must pick the same template as the serial one
+    report_mismatches(serial_results, threaded_results)
+
+    batched_matcher = create_matcher(args, batch_scoring=True)
+    batched_ms, batched_results = run_matcher(batched_matcher, frames, args.repeat)
+    print(f"batched NCC:         {batched_ms:8.2f} ms/frame   speedup x{serial_ms / batched_ms:.2f}")
+    report_mismatches(serial_results, batched_results)
+
+    tree_matcher = create_matcher(args, classifier="tree")
+    with contextlib.redirect_stdout(io.StringIO()):
+        tree_matcher.get_decision_tree(0.9)
+    tree_ms, tree_results = run_matcher(tree_matcher, frames, args.repeat)
+    stats = tree_matcher.tree_stats
+    print(f"decision tree:       {tree_ms:8.2f} ms/frame   speedup x{serial_ms / tree_ms:.2f}   "
+          f"{stats['feature_tests'] / max(stats['frames'], 1):.1f} tests/frame, {stats['fallbacks']} fallbacks")
+    report_mismatches(serial_results, tree_results)
+
+    hash_matcher = create_matcher(args, hash_shortlist=args.hash_shortlist)
+    hash_ms, hash_results = run_matcher(hash_matcher, frames, args.repeat)
+    stats = hash_matcher.hash_stats
+    print(f"hash shortlist ({args.hash_shortlist:2d}): {hash_ms:8.2f} ms/frame   speedup x{serial_ms / hash_ms:.2f}   "
+          f"{stats['fallbacks']} fallbacks")
+    report_mismatches(serial_results, hash_results)
+
+    # Every repetition after the first one is answered from the result cache
+    cached_matcher = create_matcher(args, result_cache_size=len(frames))
+    cached_ms, cached_results = run_matcher(cached_matcher, frames, args.repeat)
+    stats = cached_matcher.result_cache_stats
+    print(f"result cache:        {cached_ms:8.2f} ms/frame   speedup x{serial_ms / cached_ms:.2f}   "
+          f"{stats['hits']} hits, {stats['misses']} misses")
+    report_mismatches(serial_results, cached_results)
+
+    # The serial matcher reuses its buffers; compare with allocating new arrays for every frame
+    allocating_matcher = create_matcher(args, reuse_buffers=False)
+    allocating_ms, allocating_results = run_matcher(allocating_matcher, frames, args.repeat)
+    print(f"without buffer pool: {allocating_ms:8.2f} ms/frame   (serial with pool: {serial_ms:.2f} ms/frame)")
+    report_mismatches(serial_results, allocating_results)
+    # After the first pass every buffer shape is in the pool. Count the allocations on frames whose content moves,
+    # so the text bounding boxes change from frame to frame, twice to see whether the pool keeps growing
+    pool = serial_matcher.buffer_pool
+    warmup_allocations = pool.stats["allocations"]
+    for shifted_pass in range(2):
+        shifted_frames = make_shifted_frames(frames, 5, seed=shifted_pass)
+        allocations, reuses = pool.stats["allocations"], pool.stats["reuses"]
+        run_matcher(serial_matcher, shifted_frames, 1)
+        pooled_buffers = sum(len(free_buffers) for free_buffers in pool.free_buffers.values())
+        print(f"buffer pool: {warmup_allocations} buffers allocated while warming up, then "
+              f"{(pool.stats['allocations'] - allocations) / len(shifted_frames):.2f} allocations and "
+              f"{(pool.stats['reuses'] - reuses) / len(shifted_frames):.2f} reuses per shifted frame, "
+              f"{pooled_buffers} buffers of {len(pool.free_buffers)} shapes pooled")
+
+    # Content frames must give the same results with the blank frame check; blank frames skip the matching
+    blank_matcher = create_matcher(args, blank_frame_check=True)
+    blank_check_ms, blank_check_results = run_matcher(blank_matcher, frames, args.repeat)
+    print(f"blank frame check:   {blank_check_ms:8.2f} ms/frame   (serial without check: {serial_ms:.2f} ms/frame)")
+    report_mismatches(serial_results, blank_check_results)
+    blank_frames = make_blank_frames()
+    blank_ms, blank_results = run_matcher(blank_matcher, blank_frames, args.repeat)
+    unchecked_blank_ms, _ = run_matcher(serial_matcher, blank_frames, args.repeat)
+    print(f"blank frames: {blank_ms:.2f} ms/frame with the check, {unchecked_blank_ms:.2f} ms/frame without ("
+          + ", ".join(f"{name}: {match_values}" for name, (match_values, _) in blank_results.items()) + ")")
+
+    if args.calibrate_popcount:
+        with contextlib.redirect_stdout(io.StringIO()):
+            calibration = serial_matcher.calibrate_popcount_threshold([img for _, img in frames])
+        print(f"popcount calibration: threshold = {calibration['threshold']}, agreement with NCC = "
+              f"{calibration['agreement']:.3f} on {calibration['pairs']} equal-sized crops "
+              f"({calibration['ncc_matches']} NCC matches)")
+        if calibration["threshold"] is not None:
+            popcount_matcher = create_matcher(args, score_engine="popcount",
+                                              popcount_min_match_val=calibration["threshold"])
+            popcount_ms, popcount_results = run_matcher(popcount_matcher, frames, args.repeat)
+            print(f"popcount engine:     {popcount_ms:8.2f} ms/frame   speedup x{serial_ms / popcount_ms:.2f}")
+            report_mismatches(serial_results, popcount_results)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,11 @@
 import os
 import threading
 from tkinter import filedialog, messagebox
-import cv2
 import json
 from config_manager import ConfigData
 from painter import Painter
 from pattern_detection_v001 import ImageMatcher  # Import der ImageMatcher-Klasse
+from Image_functions_v001 import DecodedImageCache
 from helpers import (
     add_item_to_template,
     get_next_available_id,
@@ -22,7 +22,7 @@ class ButtonFunctions:
     wie das Laden von Bildern, Hinzufügen von Parametern und Features.
     """
 
-    def __init__(self, img_canvas, mde_config_dir, mde_config_file_name, templates_dir_name, config_tool):
+    def __init__(self, img_canvas, mde_config_dir, mde_config_file_name, templates_dir_name, config_tool, matcher_settings=None):
         """
         Initialisiert die ButtonFunctions-Klasse.
 
@@ -32,6 +32,7 @@ class ButtonFunctions:
         - mde_config_file_name (str): Name der Konfigurationsdatei.
         - templates_dir_name (str): Name des Verzeichnisses, das Bildvorlagen enthält.
         - config_tool (ConfigurationTool): Referenz zur Haupt-ConfigurationTool-Instanz.
+        - matcher_settings (dict, optional): Schlüsselwortargumente für den ImageMatcher aus dem Abschnitt [Matcher] der config.ini.
         """
         self.img_canvas = img_canvas
         self.mde_config_dir = mde_config_dir
@@ -41,9 +42,12 @@ class ButtonFunctions:
         self.mde_config_file_path = os.path.join(mde_config_dir, mde_config_file_name)
         self.templates_dir = os.path.join(mde_config_dir, templates_dir_name)
         self.config_tool = config_tool
+        self.matcher_settings = matcher_settings or {}
         self.img_path = None  # Speichert den Bildpfad global
         self.selected_key = None
         self.temp_img_id = None  # Initialisiert temp_img_id
+        # Dekodierte Bilder, gemeinsam genutzt vom Matcher und der Vorschau im ConfigurationTool
+        self.image_cache = DecodedImageCache()
 
         # Sicherstellen, dass das Konfigurationsverzeichnis, das Vorlagenverzeichnis und die config.json-Datei existieren
         self.ensure_directories_and_config(
@@ -58,7 +62,7 @@ class ButtonFunctions:
         #self.config_data_lock = threading.Lock()
 
         # ImageMatcher-Objekt für den Bildvergleich erstellen
-        self.matcher = ImageMatcher(mde_config_dir, mde_config_file_name, templates_dir_name)
+        self.matcher = ImageMatcher(mde_config_dir, mde_config_file_name, templates_dir_name, **self.matcher_settings)
 
         # Painter-Klasse initialisieren
         self.painter = Painter(img_canvas, self.mde_config_file_path)
@@ -108,8 +112,9 @@ class ButtonFunctions:
         if file_path:
             self.img_path = file_path  # Speichert den ausgewählten Bildpfad global
             # try:
-            # Bild mit OpenCV laden, um Konsistenz mit dem Matcher zu gewährleisten
-            img_cv2 = cv2.imread(file_path)
+            # Bild mit OpenCV laden, um Konsistenz mit dem Matcher zu gewährleisten;
+            # die Vorschau verwendet dasselbe dekodierte Bild aus dem Cache
+            img_cv2 = self.image_cache.get_array(file_path)
 
             if img_cv2 is None:
                 messagebox.showerror("Fehler", "Bild konnte nicht geladen werden. Bitte wähle ein gültiges Bild aus.")
@@ -177,6 +182,9 @@ class ButtonFunctions:
         # Synchronisieren mit config_tool
         self.config_tool.temp_img_id = self.temp_img_id
 
+        # Matcher aktualisieren, damit der Entscheidungsbaum die neue Vorlage berücksichtigt
+        self.matcher.refresh(self.config_data_1)
+
         return new_template_id
 
     def add_parameter_threaded(self, resize_percent_width, resize_percent_height, box_color):
@@ -322,6 +330,9 @@ class ButtonFunctions:
         feature_data = {"name": feature_name, "position": feature_pos}
         add_item_to_template(template_id, "features", feature_data, self.config_data_1)
 
+        # Matcher aktualisieren, damit das neue Feature im Entscheidungsbaum berücksichtigt wird
+        self.matcher.refresh(self.config_data_1)
+
     '''def clear_canvas(self, img_canvas, img_item):
         """
         Löscht das Canvas, außer dem geladenen Bild.
@@ -363,12 +374,10 @@ class ButtonFunctions:
 
     def reset_matcher_and_painter(self):
         """
-        Lädt die Konfiguration neu, indem der Matcher, der Painter und die config_data neu initialisiert werden.
+        Lädt die Konfiguration neu, indem der Matcher aktualisiert und der Painter neu initialisiert wird.
         """
-        # Matcher und Painter neu initialisieren
-        self.matcher = ImageMatcher(
-            self.mde_config_dir, self.mde_config_file_name, self.templates_dir_name
-        )
+        # Der Matcher baut nur hinzugefügte, geänderte oder gelöschte Vorlagen neu auf
+        self.matcher.refresh()
         #self.painter = Painter(self.img_canvas, self.config_data)
         self.painter = Painter(self.img_canvas, self.mde_config_file_path)
 
@@ -1,10 +1,42 @@
 import configparser
 import ast
 import json
-from tkinter import messagebox
 
 
 class AppConfigManager:
+    # Options of the [Matcher] section and their types, passed as keyword arguments to ImageMatcher
+    MATCHER_OPTION_TYPES = {
+        'crop_before_resize': 'boolean',
+        'max_workers': 'int',
+        'diagnostic': 'boolean',
+        'score_engine': 'str',
+        'popcount_min_match_val': 'optional_float',
+        'batch_scoring': 'boolean',
+        'classifier': 'str',
+        'candidate_fallback': 'boolean',
+        'hash_shortlist': 'int',
+        'feature_cache': 'boolean',
+        'result_cache_size': 'int',
+        'reuse_buffers': 'boolean',
+        'blank_frame_check': 'boolean',
+    }
+    # Options of the [Session] section and their types, passed as keyword arguments to MatcherSession
+    SESSION_OPTION_TYPES = {
+        'change_threshold': 'optional_float',
+        'gate_mode': 'str',
+    }
+
+    # Options of the [Pipeline] section and their types, passed as keyword arguments to RuntimePipeline
+    PIPELINE_OPTION_TYPES = {
+        'executor_workers': 'int',
+        'match_concurrency': 'int',
+        'match_queue_depth': 'int',
+        'extract_concurrency': 'int',
+        'extract_queue_depth': 'int',
+        'status_concurrency': 'int',
+        'status_queue_depth': 'int',
+    }
+
     def __init__(self, config_file):
         self.config = configparser.ConfigParser()
         self.config.read(config_file, encoding='utf-8')
@@ -19,10 +51,53 @@ class AppConfigManager:
         except (ValueError, SyntaxError):
             raise ValueError("Error parsing choices_dict in config.ini")
 
+    def get_matcher_settings(self):
+        """
+        Returns the options of the optional [Matcher] section as keyword arguments for ImageMatcher.
+        Options that are not set keep the ImageMatcher defaults.
+        """
+        return self.get_typed_options('Matcher', self.MATCHER_OPTION_TYPES)
+
+    def get_session_settings(self):
+        """
+        Returns the options of the optional [Session] section as keyword arguments for MatcherSession.
+        Options that are not set keep the MatcherSession defaults.
+        """
+        return self.get_typed_options('Session', self.SESSION_OPTION_TYPES)
+
+    def get_pipeline_settings(self):
+        """
+        Returns the options of the optional [Pipeline] section as keyword arguments for RuntimePipeline.
+        Options that are not set keep the RuntimePipeline defaults.
+        """
+        return self.get_typed_options('Pipeline', self.PIPELINE_OPTION_TYPES)
+
+    def get_typed_options(self, section, option_types):
+        """
+        Reads the given options of a section, converted to their types. Missing sections or options are skipped.
+        An empty value of an 'optional_float' option is returned as None.
+        """
+        settings = {}
+        if not self.config.has_section(section):
+            return settings
+        getters = {
+            'boolean': self.config.getboolean,
+            'int': self.config.getint,
+            'float': self.config.getfloat,
+            'str': self.config.get,
+            'optional_float': lambda section, option: (
+                self.config.getfloat(section, option) if self.config.get(section, option).strip() else None
+            ),
+        }
+        for option, option_type in option_types.items():
+            if self.config.has_option(section, option):
+                try:
+                    settings[option] = getters[option_type](section, option)
+                except ValueError:
+                    raise ValueError(f"Error parsing '{option}' in the [{section}] section of config.ini")
+        return settings
 
 
-import json
-from tkinter import messagebox
 
 class ConfigData:
     # Class-level attributes to hold shared configuration data and file path
@@ -46,6 +121,8 @@ class ConfigData:
                 ConfigData.config_data = json.load(file)
             print("[INFO] Configuration data loaded successfully.")
         except Exception as e:
+            # Imported here, so the headless tools that use AppConfigManager do not need tkinter
+            from tkinter import messagebox
             messagebox.showerror("Error", f"Failed to load configuration: {e}")
             ConfigData.config_data = {"images": {}}  # Use a default empty structure on failure
 
@@ -61,6 +138,7 @@ class ConfigData:
             return True
         except Exception as e:
             print(f"[ERROR] Failed to save configuration to {ConfigData.config_file_path}. Error: {e}")
+            from tkinter import messagebox
             messagebox.showerror("Error", f"Failed to save configuration: {e}")
             return False
 
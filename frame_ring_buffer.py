@@ -0,0 +1,252 @@
+''' Ring buffer of decoded frames in shared memory, so a capture process can hand frames to matching processes without
+pickling and copying them. Frame n is written to slot n % slots; every slot carries a sequence number that tells
+readers which frame it holds and whether it is being written (seqlock), so readers never block the writer. '''
+import asyncio
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+
+_HEADER_DTYPE = np.dtype([("write_seq", "<i8"), ("slots", "<i8"), ("slot_bytes", "<i8")], align=True)
+_SLOT_DTYPE = np.dtype([
+    ("seq", "<i8"),             # 2n + 1 while frame n is written, 2n + 2 once it is complete, 0 if never written
+    ("timestamp_ns", "<i8"),
+    ("height", "<i4"),
+    ("width", "<i4"),
+    ("channels", "<i4"),
+    ("frame_id", "S256"),
+], align=True)
+
+_attach_lock = threading.Lock()
+
+
+def attach_shared_memory(name):
+    """
+    Attaches to an existing shared memory block without registering it with the resource tracker of this process.
+    Before Python 3.13 every attaching process registers the block, and its tracker unlinks the block when the
+    process exits, although the block belongs to the creating process.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class FrameRingBuffer:
+    """
+    Fixed-size slots of decoded frames in a multiprocessing.shared_memory block, with one writer and any number of
+    readers in other processes.
+
+    Readers get numpy views on the shared memory, no copies. The writer never waits for readers: when the readers fall
+    more than `slots` frames behind, their oldest frames are overwritten. A reader therefore checks with is_current
+    after using a view whether the frame was overwritten meanwhile, and discards its result if so (match_frames does
+    this).
+
+    Example:
+        ring = FrameRingBuffer(slots=8)                        # capture process
+        ring.write(img, frame_id=path, timestamp_ns=mtime_ns)
+        reader = FrameRingBuffer(ring.name, create=False)      # matching process
+        for frame_id, result in reader.match_frames(matcher):
+            ...
+    """
+    def __init__(self, name=None, slots=8, max_frame_shape=(1080, 1920, 3), create=True):
+        """
+        Parameters:
+        - name (str, optional): Name of the shared memory block. A new block gets a generated name if None.
+        - slots (int): Number of frames kept (only used when creating).
+        - max_frame_shape (tuple): Largest frame shape a slot holds, for uint8 frames (only used when creating).
+        - create (bool): Create a new block (writer) or attach to an existing one (readers).
+        """
+        if create:
+            if slots < 1:
+                raise ValueError("slots must be at least 1")
+            slot_bytes = int(np.prod(max_frame_shape))
+            size = _HEADER_DTYPE.itemsize + slots * (_SLOT_DTYPE.itemsize + slot_bytes)
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            header = np.ndarray((), dtype=_HEADER_DTYPE, buffer=self.shm.buf)
+            header["write_seq"] = 0
+            header["slots"] = slots
+            header["slot_bytes"] = slot_bytes
+        else:
+            self.shm = attach_shared_memory(name)
+        self.owner = create
+
+        self.header = np.ndarray((), dtype=_HEADER_DTYPE, buffer=self.shm.buf)
+        self.slots = int(self.header["slots"])
+        self.slot_bytes = int(self.header["slot_bytes"])
+        self.slot_meta = np.ndarray((self.slots,), dtype=_SLOT_DTYPE, buffer=self.shm.buf, offset=_HEADER_DTYPE.itemsize)
+        if create:
+            self.slot_meta[:] = np.zeros(self.slots, dtype=_SLOT_DTYPE)
+        data_offset = _HEADER_DTYPE.itemsize + self.slots * _SLOT_DTYPE.itemsize
+        self.slot_data = np.ndarray((self.slots, self.slot_bytes), dtype=np.uint8, buffer=self.shm.buf,
+                                    offset=data_offset)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, img, frame_id="", timestamp_ns=None):
+        """
+        Copies a frame into the next slot (the only copy of the frame).
+
+        Parameters:
+        - img (ndarray): The decoded frame (uint8, at most the slot size).
+        - frame_id (str): Identifies the frame for the readers, e.g. its path (at most 256 bytes).
+        - timestamp_ns (int, optional): Capture time of the frame. Defaults to now.
+
+        Returns:
+        - int: The sequence number of the frame.
+        """
+        img = np.ascontiguousarray(img)
+        if img.dtype != np.uint8:
+            raise ValueError("Only uint8 frames are supported")
+        if img.nbytes > self.slot_bytes:
+            raise ValueError(f"Frame of {img.nbytes} bytes does not fit into a slot of {self.slot_bytes} bytes")
+
+        seq = int(self.header["write_seq"])
+        slot = seq % self.slots
+        meta = self.slot_meta[slot]
+        # Odd: readers know the slot is being written
+        meta["seq"] = 2 * seq + 1
+        self.slot_data[slot, :img.nbytes] = img.reshape(-1)
+        meta["height"] = img.shape[0]
+        meta["width"] = img.shape[1]
+        meta["channels"] = img.shape[2] if img.ndim == 3 else 0
+        meta["timestamp_ns"] = time.time_ns() if timestamp_ns is None else timestamp_ns
+        meta["frame_id"] = str(frame_id).encode("utf-8")[:256]
+        meta["seq"] = 2 * seq + 2
+        self.header["write_seq"] = seq + 1
+        return seq
+
+    def latest_sequence(self):
+        """
+        Returns the number of frames written so far; the newest frame has sequence number latest_sequence() - 1.
+        """
+        return int(self.header["write_seq"])
+
+    def is_current(self, seq):
+        """
+        Checks whether the slot of frame seq still holds that complete frame.
+        """
+        return int(self.slot_meta[seq % self.slots]["seq"]) == 2 * seq + 2
+
+    def get_frame(self, seq):
+        """
+        Returns frame seq without copying it.
+
+        Returns:
+        - tuple or None: (frame_id, timestamp_ns, image view), or None if the frame is not written yet or was
+          overwritten.
+        """
+        if not self.is_current(seq):
+            return None
+        meta = self.slot_meta[seq % self.slots]
+        height, width, channels = int(meta["height"]), int(meta["width"]), int(meta["channels"])
+        shape = (height, width, channels) if channels else (height, width)
+        frame_id = meta["frame_id"].decode("utf-8", errors="replace")
+        timestamp_ns = int(meta["timestamp_ns"])
+        image = self.slot_data[seq % self.slots, :int(np.prod(shape))].reshape(shape)
+        # The metadata must still belong to frame seq, otherwise the writer reused the slot while it was read
+        if not self.is_current(seq):
+            return None
+        return frame_id, timestamp_ns, image
+
+    def read_next(self, seq, worker_index=0, worker_count=1):
+        """
+        Reads the next frame of a reader from sequence number seq on.
+
+        Returns:
+        - tuple: (next seq, (seq, frame_id, timestamp_ns, image view) or None if no new frame is written yet).
+        """
+        while True:
+            if seq % worker_count != worker_index:
+                seq += 1
+                continue
+            latest = self.latest_sequence()
+            if seq >= latest:
+                return seq, None
+            # A reader more than `slots` frames behind continues with the oldest frame still in the buffer
+            if seq < latest - self.slots:
+                seq = latest - self.slots
+                continue
+            frame = self.get_frame(seq)
+            if frame is not None:
+                return seq + 1, (seq,) + frame
+            seq += 1
+
+    def frames(self, start=None, worker_index=0, worker_count=1, poll_interval=0.01, stop_event=None):
+        """
+        Yields the frames as (seq, frame_id, timestamp_ns, image view). Frames that were overwritten before this
+        reader got to them are skipped.
+
+        Parameters:
+        - start (int, optional): First sequence number. Defaults to the next frame written.
+        - worker_index, worker_count (int): Share the frames among several readers; this reader takes the frames
+          with seq % worker_count == worker_index.
+        - poll_interval (float): Seconds to sleep while no new frame is available.
+        - stop_event (optional): threading/multiprocessing Event that ends the iteration.
+        """
+        seq = self.latest_sequence() if start is None else start
+        while stop_event is None or not stop_event.is_set():
+            seq, frame = self.read_next(seq, worker_index, worker_count)
+            if frame is None:
+                time.sleep(poll_interval)
+                continue
+            yield frame
+
+    async def frames_async(self, start=None, worker_index=0, worker_count=1, poll_interval=0.01, stop_event=None):
+        """
+        Yields the frames as (frame_id, timestamp_ns, image), the frame source format of
+        runtime_pipeline.RuntimePipeline and frame_stream.FrameStream.
+
+        A pipeline keeps its frames across several stages, longer than the writer leaves a slot alone, so each frame
+        is copied out of its slot. Frames overwritten while they were copied are skipped.
+        """
+        seq = self.latest_sequence() if start is None else start
+        while stop_event is None or not stop_event.is_set():
+            seq, frame = self.read_next(seq, worker_index, worker_count)
+            if frame is None:
+                await asyncio.sleep(poll_interval)
+                continue
+            frame_seq, frame_id, timestamp_ns, image = frame
+            image = image.copy()
+            if self.is_current(frame_seq):
+                yield frame_id, timestamp_ns, image
+
+    def match_frames(self, matcher, min_match_val=0.9, **frames_options):
+        """
+        Matches the frames of the buffer in place.
+
+        Yields:
+        - tuple: (frame_id, (match_values, temp_img_id)) of every frame that was not overwritten while it was matched.
+        """
+        for seq, frame_id, _, image in self.frames(**frames_options):
+            result = matcher.match_images(image, min_match_val)
+            if self.is_current(seq):
+                yield frame_id, result
+
+    def close(self):
+        """
+        Detaches from the shared memory; the creating process also releases it.
+        """
+        # The views must be released before the shared memory can be closed
+        self.header = self.slot_meta = self.slot_data = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                # Already removed, e.g. by the resource tracker of a reader of an older version
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,255 @@
+''' Streaming ingestion of captured frames: a capture directory is polled with an os.scandir based mtime index and new
+frames are passed through a bounded queue to the consumer, e.g. the ImageMatcher. When the consumer falls behind, the
+oldest queued frames are dropped, so the stream always works on the most recent screens. '''
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import deque
+from Image_functions_v001 import cv2
+from pattern_detection_v001 import MatcherSession
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+class DirectoryWatcher:
+    """
+    Finds new and rewritten image files in a directory by comparing (mtime, size) of each file with the previous scan.
+    """
+    def __init__(self, directory, extensions=IMAGE_EXTENSIONS, recursive=False, settle_time=0.2,
+                 include_existing=False):
+        """
+        Parameters:
+        - directory (str): The capture directory.
+        - extensions (tuple): File extensions of the frames.
+        - recursive (bool): Also watch the subdirectories.
+        - settle_time (float): Seconds a file must be unmodified before it is reported, so files that are still
+          being written are not read half-finished.
+        - include_existing (bool): Report the files already in the directory on the first scan.
+        """
+        self.directory = directory
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self.recursive = recursive
+        self.settle_time = settle_time
+        # {path: (mtime_ns, size)} of the reported files still in the directory
+        self.index = {}
+        # Set when the last scan could not read the directory or one of its subdirectories
+        self.scan_failed = False
+        if not include_existing:
+            self.index = {path: stamp for path, stamp in self.scan_directory(self.directory)}
+
+    def scan_directory(self, directory):
+        """
+        Yields (path, (mtime_ns, size)) of the frame files of a directory.
+        """
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive:
+                                yield from self.scan_directory(entry.path)
+                        elif entry.name.lower().endswith(self.extensions):
+                            stat = entry.stat()
+                            yield entry.path, (stat.st_mtime_ns, stat.st_size)
+                    except OSError:
+                        # The file was removed while scanning
+                        continue
+        except OSError as e:
+            self.scan_failed = True
+            print(f"Error scanning capture directory {directory}: {e}", file=sys.stderr)
+
+    def poll(self):
+        """
+        Scans the directory once.
+
+        Returns:
+        - list: (path, mtime_ns) of the new or rewritten files that settled, oldest first.
+        """
+        settled_before = time.time_ns() - int(self.settle_time * 1e9)
+        new_files = []
+        index = {}
+        self.scan_failed = False
+        for path, stamp in self.scan_directory(self.directory):
+            if self.index.get(path) != stamp and stamp[0] <= settled_before:
+                index[path] = stamp
+                new_files.append((path, stamp[0]))
+            elif path in self.index:
+                # Unchanged, or rewritten but not settled yet (reported once it settles)
+                index[path] = self.index[path]
+        if self.scan_failed:
+            # Files of a directory that could not be read are not gone, keep them so they are not reported again
+            index = dict(self.index, **index)
+        # Files that were removed, e.g. by a rotating capture directory, are forgotten
+        self.index = index
+        new_files.sort(key=lambda new_file: (new_file[1], new_file[0]))
+        return new_files
+
+
+class DropOldestQueue:
+    """
+    Bounded thread-safe FIFO queue. Putting an item into a full queue drops the oldest item instead of blocking the
+    producer. get blocks on a condition variable, without polling.
+    """
+    def __init__(self, maxsize):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.items = deque()
+        self.maxsize = maxsize
+        self.closed = False
+        self.dropped = 0
+        self._condition = threading.Condition()
+
+    def put(self, item):
+        """
+        Appends an item and returns the dropped oldest item, or None.
+        """
+        with self._condition:
+            dropped_item = None
+            if len(self.items) >= self.maxsize:
+                dropped_item = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self._condition.notify()
+            return dropped_item
+
+    def get(self, timeout=None):
+        """
+        Removes and returns the oldest item.
+
+        Returns:
+        - The item, or None if the timeout expired or the queue was closed and is empty.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            return self.items.popleft() if self.items else None
+
+    def close(self):
+        """
+        Wakes all waiting consumers; items already queued can still be taken.
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def __len__(self):
+        with self._condition:
+            return len(self.items)
+
+
+class FrameStream:
+    """
+    Watches a capture directory on a background thread and yields the new frames as (path, mtime_ns, image), through
+    a generator (for frame in stream) or an async iterator (async for frame in stream).
+
+    Example:
+        with FrameStream("captures", maxsize=4) as stream:
+            for path, match_result in stream.match(matcher, session_settings=config_manager.get_session_settings()):
+                print(path, match_result)
+    """
+    def __init__(self, directory, maxsize=8, poll_interval=0.5, **watcher_options):
+        """
+        Parameters:
+        - directory (str): The capture directory.
+        - maxsize (int): Frames kept in the queue; when full, the oldest frame is dropped.
+        - poll_interval (float): Seconds between two directory scans.
+        - watcher_options: Passed to DirectoryWatcher (extensions, recursive, settle_time, include_existing).
+        """
+        self.watcher = DirectoryWatcher(directory, **watcher_options)
+        self.queue = DropOldestQueue(maxsize)
+        self.poll_interval = poll_interval
+        self.stats = {"seen": 0, "dropped": 0, "unreadable": 0, "delivered": 0}
+        self.session = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run_watcher, name="FrameStream", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops watching the directory and ends the iteration once the queued frames are consumed.
+        """
+        self._stop_event.set()
+        self.queue.close()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def run_watcher(self):
+        while not self._stop_event.is_set():
+            for new_file in self.watcher.poll():
+                self.stats["seen"] += 1
+                if self.queue.put(new_file) is not None:
+                    self.stats["dropped"] += 1
+            # Sleeps until the next scan, or returns at once when the stream is stopped
+            self._stop_event.wait(self.poll_interval)
+
+    def get_frame(self, timeout=None):
+        """
+        Waits for the next frame and decodes it. Frames that cannot be decoded are skipped.
+
+        Returns:
+        - tuple or None: (path, mtime_ns, image), or None if the timeout expired or the stream was stopped.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            new_file = self.queue.get(remaining)
+            if new_file is None:
+                return None
+            path, mtime_ns = new_file
+            image = cv2.imread(path)
+            if image is None:
+                self.stats["unreadable"] += 1
+                continue
+            self.stats["delivered"] += 1
+            return path, mtime_ns, image
+
+    def __iter__(self):
+        self.start()
+        while True:
+            frame = self.get_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def __aiter__(self):
+        return self.iter_async()
+
+    async def iter_async(self):
+        self.start()
+        while True:
+            # The blocking wait and the decoding run on a worker thread, so the event loop stays responsive
+            frame = await asyncio.to_thread(self.get_frame)
+            if frame is None:
+                return
+            yield frame
+
+    def match(self, matcher, min_match_val=0.9, session_settings=None):
+        """
+        Matches every frame of the stream with a MatcherSession, which tests the last matched template first and
+        reuses the previous result for unchanged frames. The session is kept in self.session for its counters.
+
+        Parameters:
+        - matcher (ImageMatcher): The matcher holding the templates.
+        - min_match_val (float): Minimum similarity score required for a match.
+        - session_settings (dict, optional): Keyword arguments for MatcherSession, see
+          AppConfigManager.get_session_settings().
+
+        Yields:
+        - tuple: (path, (match_values, temp_img_id)) per frame.
+        """
+        self.session = MatcherSession(matcher, min_match_val, **(session_settings or {}))
+        for path, _, image in self:
+            yield path, self.session.match(image)
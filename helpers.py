@@ -253,6 +253,99 @@ def list_machine_status_conditions(data_input, img_temp_id):
     machine_status_conditions = image.get("machine_status_conditions", [])
     return machine_status_conditions
 
+def compare_parameter_value(value, comparison_operator, expected):
+    """
+    Compares a recognised parameter value with the value of a condition.
+    The expected value '*' matches any non-empty value and an empty (or blank) expected value matches an empty value.
+    Numbers are compared numerically, everything else as text; '>', '<', '>=' and '<=' only hold for numbers.
+    :param value: The recognised value (str or None if it could not be read).
+    :param comparison_operator: '=', '!=', '>', '<', '>=' or '<='.
+    :param expected: The value of the condition.
+    :return: True if the comparison holds.
+    """
+    value = "" if value is None else str(value).strip()
+    expected = str(expected)
+    if comparison_operator in ("=", "!="):
+        if expected == "*":
+            equal = value != ""
+        elif expected.strip() == "":
+            equal = value == ""
+        else:
+            try:
+                equal = float(value) == float(expected)
+            except ValueError:
+                equal = value == expected.strip()
+        return equal if comparison_operator == "=" else not equal
+
+    try:
+        value_number, expected_number = float(value), float(expected)
+    except ValueError:
+        return False
+    comparisons = {
+        ">": value_number > expected_number,
+        "<": value_number < expected_number,
+        ">=": value_number >= expected_number,
+        "<=": value_number <= expected_number,
+    }
+    return comparisons.get(comparison_operator, False)
+
+def evaluate_conditions(conditions, parameter_values):
+    """
+    Evaluates a (nested) condition group of machine_status_conditions against recognised parameter values.
+    The logic_operator of an operand joins it with the operands before it; AND binds stronger than OR.
+    Groups created with create_logical_condition use their 'operator' for all operands.
+    :param conditions: The conditions dict {"operands": [...]}.
+    :param parameter_values: Dictionary {parameter name: recognised value}.
+    :return: True if the conditions hold. An empty group holds.
+    """
+    # Split the operands into OR-joined groups of AND-joined operands
+    or_groups = [[]]
+    for idx, operand in enumerate(conditions.get("operands", [])):
+        logic_operator = operand.get("logic_operator") or conditions.get("operator") or "AND"
+        if idx > 0 and logic_operator.upper() == "OR":
+            or_groups.append([])
+        or_groups[-1].append(operand)
+
+    def operand_holds(operand):
+        if "operands" in operand:
+            return evaluate_conditions(operand, parameter_values)
+        comparison_operator = operand.get("comparison_operator", operand.get("operator", "="))
+        return compare_parameter_value(parameter_values.get(operand.get("parameter")), comparison_operator,
+                                       operand.get("value", ""))
+
+    return any(all(operand_holds(operand) for operand in and_group) for and_group in or_groups)
+
+def get_condition_parameters(machine_status_conditions):
+    """
+    Collects the names of the parameters the conditions of machine_status_conditions refer to.
+    :param machine_status_conditions: The machine_status_conditions list of a template.
+    :return: A set of parameter names.
+    """
+    parameter_names = set()
+
+    def collect(conditions):
+        for operand in conditions.get("operands", []):
+            if "operands" in operand:
+                collect(operand)
+            elif operand.get("parameter") is not None:
+                parameter_names.add(operand["parameter"])
+
+    for machine_status_condition in machine_status_conditions or []:
+        collect(machine_status_condition.get("conditions", {}))
+    return parameter_names
+
+def evaluate_machine_status(machine_status_conditions, parameter_values):
+    """
+    Determines the machine status of a screen from its recognised parameter values.
+    :param machine_status_conditions: The machine_status_conditions list of a template.
+    :param parameter_values: Dictionary {parameter name: recognised value}.
+    :return: The status of the first entry whose conditions hold, or None.
+    """
+    for machine_status_condition in machine_status_conditions or []:
+        if evaluate_conditions(machine_status_condition.get("conditions", {}), parameter_values):
+            return machine_status_condition.get("status")
+    return None
+
 def copy_and_rename_file(file_path, dst_dir, new_filename):
     """
     Copies and renames a file to the specified directory.
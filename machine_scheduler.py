@@ -0,0 +1,226 @@
+''' Scheduler for the capture streams of many machines. Every machine has its own configuration directory and keeps one
+warm ImageMatcher; the frames of all machines are matched on one shared thread pool. '''
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pattern_detection_v001 import ImageMatcher, MatcherSession
+
+
+class MachineStream:
+    """
+    The frames, the matcher and the matching session of one machine.
+    """
+    def __init__(self, name, matcher, weight=1, max_latency=None, max_pending=8, max_in_flight=1,
+                 min_match_val=0.9, session_settings=None):
+        self.name = name
+        self.matcher = matcher
+        self.session = MatcherSession(matcher, min_match_val, **(session_settings or {}))
+        self.weight = weight
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self.min_match_val = min_match_val
+        # Frames waiting to be matched: (frame_id, image, callback, submit time)
+        self.pending = deque()
+        self.in_flight = 0
+        # Smooth weighted round-robin state
+        self.current_weight = 0
+        self.started = time.monotonic()
+        self.stats = {"submitted": 0, "processed": 0, "dropped_stale": 0, "dropped_overflow": 0, "errors": 0,
+                      "latency_total": 0.0, "latency_max": 0.0}
+
+    def is_ready(self):
+        return bool(self.pending) and self.in_flight < self.max_in_flight
+
+
+class MachineScheduler:
+    """
+    Matches the frames of many machine streams on a shared worker pool.
+
+    Frames are dispatched with smooth weighted round-robin over the streams that have frames waiting, so a busy
+    machine cannot starve the others. A stream with max_latency drops frames that waited longer than that, keeping
+    its lag bounded; a full stream queue drops its oldest frame.
+
+    Example:
+        scheduler = MachineScheduler(max_workers=4, matcher_settings=config_manager.get_matcher_settings(),
+                                     session_settings=config_manager.get_session_settings())
+        scheduler.add_stream("TNC640_1", "machines/TNC640_1/ConfigFiles", max_latency=2.0)
+        scheduler.submit("TNC640_1", frame_id, img, callback=lambda name, frame_id, result: print(name, result))
+        ...
+        print(scheduler.get_metrics())
+        scheduler.close()
+    """
+    def __init__(self, max_workers=4, matcher_settings=None, session_settings=None):
+        """
+        Parameters:
+        - max_workers (int): Threads of the shared pool, i.e. frames matched at the same time.
+        - matcher_settings (dict, optional): Keyword arguments for every ImageMatcher (see the [Matcher] section).
+          The matchers do not get their own thread pools; the shared pool is the only source of parallelism.
+        - session_settings (dict, optional): Keyword arguments for the MatcherSession of every stream (see the
+          [Session] section). The session tests the last matched template first and skips unchanged frames.
+        """
+        self.max_workers = max_workers
+        self.matcher_settings = dict(matcher_settings or {}, max_workers=0)
+        self.session_settings = dict(session_settings or {})
+        self.streams = {}
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="MachineScheduler")
+        self.in_flight = 0
+        self.closed = False
+        self._condition = threading.Condition()
+        self._dispatcher = threading.Thread(target=self.dispatch_frames, name="MachineSchedulerDispatch", daemon=True)
+        self._dispatcher.start()
+
+    def add_stream(self, name, configFiles_dir, mde_config_file_name="mde_config.json", templates_dir_name="templates",
+                   weight=1, max_latency=None, max_pending=8, max_in_flight=1, min_match_val=0.9):
+        """
+        Adds a machine and loads its matcher.
+
+        Parameters:
+        - name (str): Name of the machine stream.
+        - configFiles_dir, mde_config_file_name, templates_dir_name: The configuration of the machine, as for
+          ImageMatcher.
+        - weight (int): Share of the dispatches when several streams have frames waiting.
+        - max_latency (float, optional): Seconds a frame may wait before it is dropped as stale.
+        - max_pending (int): Frames kept waiting; when full, the oldest frame is dropped.
+        - max_in_flight (int): Frames of this stream dispatched at the same time. 1 keeps the results in frame order.
+          The session of the stream matches its frames one at a time.
+        - min_match_val (float): Minimum similarity score required for a match.
+        """
+        if weight < 1:
+            raise ValueError("weight must be at least 1")
+        matcher = ImageMatcher(configFiles_dir, mde_config_file_name, templates_dir_name, **self.matcher_settings)
+        with self._condition:
+            if name in self.streams:
+                raise ValueError(f"Stream already exists: {name}")
+            self.streams[name] = MachineStream(name, matcher, weight, max_latency, max_pending, max_in_flight,
+                                               min_match_val, self.session_settings)
+
+    def remove_stream(self, name):
+        """
+        Removes a machine stream; its waiting frames are discarded.
+        """
+        with self._condition:
+            stream = self.streams.pop(name)
+            stream.pending.clear()
+        stream.matcher.close()
+
+    def submit(self, name, frame_id, img, callback=None):
+        """
+        Queues a frame of a machine.
+
+        Parameters:
+        - name (str): Name of the machine stream.
+        - frame_id: Identifies the frame in the callback, e.g. its path or timestamp.
+        - img (ndarray): The frame.
+        - callback (callable, optional): callback(name, frame_id, (match_values, temp_img_id)), called on a worker
+          thread after the frame was matched.
+        """
+        with self._condition:
+            if self.closed:
+                raise RuntimeError("The scheduler is closed")
+            stream = self.streams[name]
+            stream.stats["submitted"] += 1
+            if len(stream.pending) >= stream.max_pending:
+                stream.pending.popleft()
+                stream.stats["dropped_overflow"] += 1
+            stream.pending.append((frame_id, img, callback, time.monotonic()))
+            self._condition.notify_all()
+
+    def select_stream(self, now):
+        """
+        Picks the next stream with smooth weighted round-robin, after dropping its stale frames. Called with the
+        condition held.
+
+        Returns:
+        - MachineStream or None if no stream has a frame ready.
+        """
+        for stream in self.streams.values():
+            if stream.max_latency is not None:
+                while stream.pending and now - stream.pending[0][3] > stream.max_latency:
+                    stream.pending.popleft()
+                    stream.stats["dropped_stale"] += 1
+
+        ready_streams = [stream for stream in self.streams.values() if stream.is_ready()]
+        if not ready_streams:
+            return None
+        total_weight = 0
+        for stream in ready_streams:
+            stream.current_weight += stream.weight
+            total_weight += stream.weight
+        selected = max(ready_streams, key=lambda stream: stream.current_weight)
+        selected.current_weight -= total_weight
+        return selected
+
+    def dispatch_frames(self):
+        with self._condition:
+            while not self.closed:
+                stream = None
+                if self.in_flight < self.max_workers:
+                    stream = self.select_stream(time.monotonic())
+                if stream is None:
+                    # Woken by submit, by a finished frame or, for the latency cap, after a short while
+                    self._condition.wait(timeout=0.1)
+                    continue
+                frame_id, img, callback, submitted = stream.pending.popleft()
+                stream.in_flight += 1
+                self.in_flight += 1
+                self.executor.submit(self.match_frame, stream, frame_id, img, callback, submitted)
+
+    def match_frame(self, stream, frame_id, img, callback, submitted):
+        result = (-1, -1)
+        try:
+            result = stream.session.match(img)
+        except Exception as e:
+            stream.stats["errors"] += 1
+            print(f"Error matching frame {frame_id} of {stream.name}: {e}")
+        latency = time.monotonic() - submitted
+        with self._condition:
+            stream.in_flight -= 1
+            self.in_flight -= 1
+            stream.stats["processed"] += 1
+            stream.stats["latency_total"] += latency
+            stream.stats["latency_max"] = max(stream.stats["latency_max"], latency)
+            self._condition.notify_all()
+        if callback is not None:
+            callback(stream.name, frame_id, result)
+
+    def get_metrics(self):
+        """
+        Returns per-stream metrics: {name: {"throughput_fps", "lag_s" (age of the oldest waiting frame), "pending",
+        "latency_avg_s", "latency_max_s", "submitted", "processed", "dropped_stale", "dropped_overflow", "errors",
+        "gate_skips" (frames that reused the previous result), "last_template_hits", "full_scans"}}
+        """
+        now = time.monotonic()
+        metrics = {}
+        with self._condition:
+            for name, stream in self.streams.items():
+                stats = stream.stats
+                metrics[name] = {
+                    "throughput_fps": stats["processed"] / max(now - stream.started, 1e-9),
+                    "lag_s": now - stream.pending[0][3] if stream.pending else 0.0,
+                    "pending": len(stream.pending),
+                    "latency_avg_s": stats["latency_total"] / stats["processed"] if stats["processed"] else 0.0,
+                    "latency_max_s": stats["latency_max"],
+                    "submitted": stats["submitted"],
+                    "processed": stats["processed"],
+                    "dropped_stale": stats["dropped_stale"],
+                    "dropped_overflow": stats["dropped_overflow"],
+                    "errors": stats["errors"],
+                    "gate_skips": stream.session.stats["gate_skips"],
+                    "last_template_hits": stream.session.stats["last_template_hits"],
+                    "full_scans": stream.session.stats["full_scans"],
+                }
+        return metrics
+
+    def close(self):
+        """
+        Stops dispatching, waits for the frames being matched and releases the matchers.
+        """
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        self._dispatcher.join()
+        self.executor.shutdown(wait=True)
+        for stream in self.streams.values():
+            stream.matcher.close()
@@ -0,0 +1,188 @@
+''' Headless command-line matcher: classifies folders of screenshots with the templates of mde_config.json and
+streams one result per image as JSONL or CSV, without starting the Tk application.
+
+Example:
+    python match_cli.py captures/ --recursive --format csv --output results.csv --processes 4
+'''
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from config_manager import AppConfigManager
+from pattern_detection_v001 import ImageMatcher
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+CSV_COLUMNS = ["path", "temp_img_id", "feature_scores", "blank_kind", "decode_ms", "match_ms", "error"]
+
+# Matcher of a worker process, created once by init_worker
+_worker_matcher = None
+_worker_verbose = False
+
+
+def list_image_files(inputs, recursive=False):
+    """
+    Returns the image files of the given files and directories, directories sorted by file name.
+    """
+    for input_path in inputs:
+        if os.path.isfile(input_path):
+            yield input_path
+            continue
+        if not os.path.isdir(input_path):
+            print(f"Skipping missing input: {input_path}", file=sys.stderr)
+            continue
+        if recursive:
+            for dirpath, dirnames, filenames in os.walk(input_path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    if filename.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(dirpath, filename)
+        else:
+            for filename in sorted(os.listdir(input_path)):
+                path = os.path.join(input_path, filename)
+                if filename.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path):
+                    yield path
+
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def quiet(verbose):
+    """
+    The matcher prints its match values; they go to stderr with --verbose and are dropped otherwise, so stdout
+    only carries the results.
+    """
+    return contextlib.redirect_stdout(sys.stderr if verbose else io.StringIO())
+
+
+def create_matcher(matcher_args, verbose):
+    with quiet(verbose):
+        return ImageMatcher(*matcher_args["dirs"], **matcher_args["settings"])
+
+
+def init_worker(matcher_args, verbose):
+    global _worker_matcher, _worker_verbose
+    _worker_matcher = create_matcher(matcher_args, verbose)
+    _worker_verbose = verbose
+
+
+def match_chunk(paths, min_match_val):
+    """
+    Matches a chunk of images in a worker process.
+    """
+    with quiet(_worker_verbose):
+        return list(_worker_matcher.match_many(paths, min_match_val))
+
+
+def match_files(paths, matcher_args, min_match_val, processes, chunk_size, verbose):
+    """
+    Yields the match results of all paths in input order, matched in this process or fanned out over a process pool.
+    """
+    if processes <= 1:
+        matcher = create_matcher(matcher_args, verbose)
+        try:
+            for path in paths:
+                with quiet(verbose):
+                    result = next(matcher.match_many([path], min_match_val))
+                yield result
+        finally:
+            matcher.close()
+        return
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker,
+                             initargs=(matcher_args, verbose)) as executor:
+        chunks = chunked(paths, chunk_size)
+        for results in executor.map(partial(match_chunk, min_match_val=min_match_val), chunks):
+            yield from results
+
+
+class ResultWriter:
+    """
+    Writes match results as JSON lines or CSV rows, flushing every row so the output can be followed live.
+    """
+    def __init__(self, output, output_format):
+        self.output = output
+        self.output_format = output_format
+        self.csv_writer = None
+        if output_format == "csv":
+            self.csv_writer = csv.DictWriter(output, fieldnames=CSV_COLUMNS)
+            self.csv_writer.writeheader()
+
+    def write(self, result):
+        result = dict(result, decode_ms=round(result["decode_ms"], 3), match_ms=round(result["match_ms"], 3))
+        if self.csv_writer is not None:
+            self.csv_writer.writerow(dict(result, feature_scores=json.dumps(result["feature_scores"])))
+        else:
+            self.output.write(json.dumps(result) + "\n")
+        self.output.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classify screenshots with the templates of mde_config.json.")
+    parser.add_argument("inputs", nargs="+", help="Image files and directories.")
+    parser.add_argument("--recursive", action="store_true", help="Include the images of subdirectories.")
+    parser.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    parser.add_argument("--output", help="Output file. Defaults to stdout.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes, each with its own matcher (1 = match in this process).")
+    parser.add_argument("--chunk-size", type=int, default=16, help="Images sent to a worker process at once.")
+    parser.add_argument("--min-match-val", type=float, default=0.9)
+    parser.add_argument("--app-config", default="config.ini",
+                        help="Application config whose [Matcher] section configures the matcher.")
+    parser.add_argument("--config-dir", default="ConfigFiles")
+    parser.add_argument("--config-file", default="mde_config.json")
+    parser.add_argument("--templates-dir", default="templates")
+    parser.add_argument("--verbose", action="store_true", help="Show the matcher output on stderr.")
+    args = parser.parse_args()
+
+    settings = {}
+    if os.path.exists(args.app_config):
+        settings = AppConfigManager(args.app_config).get_matcher_settings()
+    if args.processes > 1:
+        # The work is spread over processes, a thread pool per worker would only compete for the same cores
+        settings["max_workers"] = 0
+    matcher_args = {"dirs": (args.config_dir, args.config_file, args.templates_dir), "settings": settings}
+
+    output = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    writer = ResultWriter(output, args.format)
+    counts = {"images": 0, "matched": 0, "blank": 0, "unmatched": 0, "errors": 0}
+    start = time.perf_counter()
+    try:
+        paths = list_image_files(args.inputs, args.recursive)
+        for result in match_files(paths, matcher_args, args.min_match_val, args.processes, args.chunk_size,
+                                  args.verbose):
+            writer.write(result)
+            counts["images"] += 1
+            if result["error"]:
+                counts["errors"] += 1
+            elif result["blank_kind"] is not None:
+                counts["blank"] += 1
+            elif result["temp_img_id"] is None:
+                counts["unmatched"] += 1
+            else:
+                counts["matched"] += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"{counts['images']} images: {counts['matched']} matched, {counts['blank']} blank, "
+          f"{counts['unmatched']} unmatched, {counts['errors']} errors in {elapsed:.2f} s ({counts['images'] / max(elapsed, 1e-9):.1f} images/s)",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
 import json
 import os
-from Image_functions_v001 import cv2, resize_image_cv2, prepare_img_for_ocr as mde_img_filter
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from Image_functions_v001 import cv2, BufferPool, resize_image_cv2, resize_crop_cv2, is_downscaling, convert_to_grayscale, dhash_image, classify_blank_frame, prepare_img_for_ocr_fast as mde_img_filter, prepare_crops_for_ocr
+from template_decision_tree import compile_decision_tree, classify
+from template_hash_index import TemplateHashIndex
+from template_feature_cache import TemplateFeatureCache
 
 
 
@@ -32,7 +41,13 @@ class ImageMatcher:
     - mde_config_data (dict): Loaded JSON data with template configurations.
     - templa
     """
-    def __init__(self, configFiles_dir, mde_config_file_name, templates_dir_name): 
+    # Identifies the template preprocessing; change it whenever mde_img_filter changes its output
+    TEMPLATE_PREPROCESSING_VERSION = "prepare_img_for_ocr-1"
+
+    def __init__(self, configFiles_dir, mde_config_file_name, templates_dir_name, crop_before_resize=False,
+                 max_workers=0, diagnostic=False, score_engine="ncc", popcount_min_match_val=None,
+                 batch_scoring=False, classifier="linear", candidate_fallback=True, hash_shortlist=0,
+                 feature_cache=True, result_cache_size=0, reuse_buffers=True, blank_frame_check=False): 
         """
         Initializes the ImageMatcher with configuration and template directories.
 
@@ -40,7 +55,89 @@ class ImageMatcher:
         - configFiles_dir (str): Directory for storing configuration files.
         - mde_config_file_name (str): Name of the JSON configuration file.
         - templates_dir_name (str): Directory for storing template images.
+        - crop_before_resize (bool): Map each feature rectangle into the input image and resize only the crop,
+          instead of resizing the whole input image to the template size. Only used for inputs that are scaled down
+          to the template size; smaller inputs are resized fully, see resize_crop_cv2.
+        - max_workers (int): Number of threads used to evaluate templates concurrently. 0 or 1 evaluates them serially.
+        - diagnostic (bool): Compute every feature of every template instead of rejecting a template at its first
+          failing feature. The scores of the last frame are kept in last_feature_scores.
+        - score_engine (str): "ncc" scores features with cv2.matchTemplate (TM_CCOEFF_NORMED). "popcount" scores
+          equal-sized filtered crops by the fraction of equal pixels, computed with XOR and popcount on bit-packed
+          crops, and falls back to NCC for crops of different size.
+        - popcount_min_match_val (float, optional): Minimum popcount similarity for a feature match. The popcount
+          score is a fraction of equal pixels, not an NCC value, so the NCC threshold cannot be used for it: without
+          this value the threshold is calibrated on the template images when the templates are loaded (see
+          calibrate_popcount_threshold), and NCC is used as long as no threshold could be calibrated.
+        - batch_scoring (bool): Filter the input crops of all features first and score all equal-sized crop pairs of
+          a frame at once with batched_ncc, instead of testing the templates one feature at a time.
+        - classifier (str): "linear" tests the templates one after another. "tree" walks a decision tree compiled
+          from the templates, which needs about log2(templates) feature tests, and verifies only the templates of
+          the reached leaf.
+        - candidate_fallback (bool): Test the remaining templates in configuration order when none of the shortlisted
+          candidates matches. Without it, frames that differ from every template image can be misclassified as
+          unmatched, but unmatched frames stay cheap.
+        - hash_shortlist (int): With the linear classifier, compare a perceptual hash of the frame with the hashes of
+          the template images first and fully verify only the hash_shortlist closest templates. 0 disables it. The
+          template hashes are kept in <mde_config>.phash.json next to the configuration file.
+        - feature_cache (bool): Keep the filtered template feature crops in ConfigFiles/template_cache, so re-creating
+          the matcher loads them instead of filtering every template image again.
+        - result_cache_size (int): Number of match results kept in an LRU cache keyed by a digest of the frame
+          content, so identical frames are not matched again. 0 disables it. Bypassed in diagnostic mode.
+        - reuse_buffers (bool): Take the resized inputs and the fixed-size intermediate images of the feature crops
+          from a buffer pool that is reused from frame to frame, instead of allocating new arrays for every frame.
+          The filtered crops take the size of their text and are still allocated per frame.
+        - blank_frame_check (bool): Classify black, no signal and screensaver frames from a downsampled histogram
+          (classify_blank_frame) before matching and return (kind, -1) for them without testing any template.
+          A kind that one of the template images shows itself is left to the templates. Bypassed in diagnostic mode.
         """    
+        if classifier not in ("linear", "tree"):
+            raise ValueError(f"Unsupported classifier: {classifier}")
+        if score_engine not in ("ncc", "popcount"):
+            raise ValueError(f"Unsupported score engine: {score_engine}")
+        self.crop_before_resize = crop_before_resize
+        self.score_engine = score_engine
+        self.popcount_min_match_val = popcount_min_match_val
+        # Threshold used for popcount scores: the configured one or the one calibrated for the loaded templates
+        self.popcount_threshold = popcount_min_match_val
+        self.batch_scoring = batch_scoring
+        self.classifier = classifier
+        self.candidate_fallback = candidate_fallback
+        self.hash_shortlist = hash_shortlist
+
+        # Decision tree over the templates, compiled on first use and whenever the templates are reloaded
+        self.decision_tree = None
+        self.decision_tree_min_match_val = None
+        self.tree_stats = {"frames": 0, "feature_tests": 0, "fallbacks": 0}
+        self._tree_lock = threading.Lock()
+
+        self.diagnostic = diagnostic
+        self.last_feature_scores = {}
+
+        # Results of recently matched frames
+        # {(digest, shape, dtype, config_version, min_match_val, template_ids): (result, pixel sample of the frame)}
+        self.result_cache_size = result_cache_size
+        self.result_cache = OrderedDict()
+        self.result_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._result_cache_lock = threading.Lock()
+        # Incremented whenever the templates change, so cached results of older configurations are never returned
+        self.config_version = 0
+
+        # Outcome counts {temp_img_id: {merkma_id: [evaluations, rejections]}} used to order the feature cascade
+        self.feature_stats = {}
+        self._stats_lock = threading.Lock()
+
+        # OpenCV releases the GIL while filtering and matching, so templates can be evaluated on a thread pool
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ImageMatcher") if max_workers > 1 else None
+        self._resize_lock = threading.Lock()
+
+        # Buffers of the resized inputs and the filtered input crops, reused from frame to frame
+        self.buffer_pool = BufferPool() if reuse_buffers else None
+
+        # Blank frame kinds of the template images {temp_img_id: (image_stamp, kind or None)}
+        self.blank_frame_check = blank_frame_check
+        self.template_blank_kinds = {}
+        self.blank_stats = {"black": 0, "no_signal": 0, "screensaver": 0}
+
         # Ensure the MDE config directory exists
         if not os.path.exists(configFiles_dir):
             os.makedirs(configFiles_dir)
@@ -58,8 +155,429 @@ class ImageMatcher:
         if not os.path.exists(self.templates_dir):
             os.makedirs(self.templates_dir)
 
-       
-     
+        # Filtered template feature crops of previous runs, valid as long as the template image and the filter are unchanged
+        self.feature_cache = None
+        if feature_cache:
+            self.feature_cache = TemplateFeatureCache(os.path.join(configFiles_dir, "template_cache"),
+                                                      self.TEMPLATE_PREPROCESSING_VERSION)
+
+        # Load and pre-filter the template feature crops once, so matching only has to preprocess the input image
+        self.template_cache = self.build_template_cache()
+
+        # Perceptual hashes of the template images, persisted next to the configuration file
+        self.hash_index = None
+        self.hash_stats = {"frames": 0, "fallbacks": 0}
+        if self.hash_shortlist > 0:
+            self.hash_index = TemplateHashIndex(os.path.splitext(self.mde_config_file_path)[0] + ".phash.json")
+            self.update_hash_index()
+        self.update_template_blank_kinds()
+        self.update_popcount_threshold()
+
+    def reload_templates(self, mde_config_data=None):
+        """
+        Reloads the template configuration and rebuilds the cache of pre-filtered template features.
+
+        Parameters:
+        - mde_config_data (dict, optional): Configuration data to use instead of re-reading mde_config.json.
+        """
+        if mde_config_data is not None:
+            self.mde_config_data = mde_config_data
+        elif os.path.exists(self.mde_config_file_path):
+            self.mde_config_data = self.load_mde_config_data(self.mde_config_file_path)
+        else:
+            self.mde_config_data = {}
+        self.template_cache = self.build_template_cache()
+        self.feature_stats = {}
+        with self._tree_lock:
+            self.decision_tree = None
+        self.update_hash_index()
+        self.update_template_blank_kinds()
+        self.update_popcount_threshold()
+        self.invalidate_result_cache()
+
+    def refresh(self, mde_config_data=None):
+        """
+        Brings the matcher in line with the current configuration without rebuilding everything: only templates that
+        were added, removed or changed (image, size or feature rectangles) are rebuilt, and of a changed template with
+        an unchanged image only the new feature rectangles are filtered.
+
+        Parameters:
+        - mde_config_data (dict, optional): Configuration data to use instead of re-reading mde_config.json.
+
+        Returns:
+        - dict: {"added": [...], "changed": [...], "removed": [...]} template IDs.
+        """
+        if mde_config_data is not None:
+            self.mde_config_data = mde_config_data
+        elif os.path.exists(self.mde_config_file_path):
+            self.mde_config_data = self.load_mde_config_data(self.mde_config_file_path)
+        else:
+            self.mde_config_data = {}
+
+        changes = {"added": [], "changed": [], "removed": []}
+        template_cache = {}
+        for temp_img_id, temp_img_data in self.mde_config_data.get("images", {}).items():
+            previous_entry = self.template_cache.get(temp_img_id)
+            if previous_entry is None:
+                template_cache[temp_img_id] = self.build_template_entry(temp_img_data)
+                changes["added"].append(temp_img_id)
+                continue
+            entry = self.build_template_entry(temp_img_data, previous_entry)
+            if self.template_entries_equal(entry, previous_entry):
+                template_cache[temp_img_id] = previous_entry
+            else:
+                template_cache[temp_img_id] = entry
+                changes["changed"].append(temp_img_id)
+        changes["removed"] = [temp_img_id for temp_img_id in self.template_cache if temp_img_id not in template_cache]
+
+        # The configuration order decides which template wins, so a reordering also invalidates the decision tree
+        reordered = list(template_cache) != list(self.template_cache)
+        self.template_cache = template_cache
+        self.roi_index = self.build_roi_index(template_cache)
+        if changes["added"] or changes["changed"] or changes["removed"] or reordered:
+            with self._stats_lock:
+                for temp_img_id in changes["changed"] + changes["removed"]:
+                    self.feature_stats.pop(temp_img_id, None)
+            with self._tree_lock:
+                self.decision_tree = None
+            self.update_hash_index()
+            self.update_template_blank_kinds()
+            self.update_popcount_threshold()
+            self.invalidate_result_cache()
+        return changes
+
+    @staticmethod
+    def template_entries_equal(entry, other_entry):
+        """
+        Checks whether two cached template entries describe the same image, size and feature rectangles.
+        """
+        return (
+            (entry["path"], entry["image_stamp"], entry["size_key"]) ==
+            (other_entry["path"], other_entry["image_stamp"], other_entry["size_key"])
+            and {merkma_id: feature["rect"] for merkma_id, feature in entry["features"].items()} ==
+            {merkma_id: feature["rect"] for merkma_id, feature in other_entry["features"].items()}
+        )
+
+    def invalidate_result_cache(self):
+        """
+        Starts a new configuration version and drops the cached match results of the previous one.
+        """
+        with self._result_cache_lock:
+            self.config_version += 1
+            self.result_cache.clear()
+
+    def update_hash_index(self):
+        """
+        Hashes new or changed template images and removes deleted templates from the hash index.
+        """
+        if self.hash_index is None:
+            return
+        template_paths = {temp_img_id: temp_img_data.get("path", "")
+                          for temp_img_id, temp_img_data in self.mde_config_data.get("images", {}).items()}
+        self.hash_index.update(template_paths, self.templates_dir)
+
+    def update_template_blank_kinds(self):
+        """
+        Classifies new or changed template images with classify_blank_frame and forgets deleted templates, so a
+        configured screen that looks blank (e.g. a template of the screensaver) is never short-circuited.
+        """
+        if not self.blank_frame_check:
+            return
+        template_blank_kinds = {}
+        for temp_img_id, template in self.template_cache.items():
+            known = self.template_blank_kinds.get(temp_img_id)
+            if known is not None and known[0] == template["image_stamp"] and template["image_stamp"] is not None:
+                template_blank_kinds[temp_img_id] = known
+                continue
+            temp_img = cv2.imread(os.path.join(self.templates_dir, template["path"]))
+            template_blank_kinds[temp_img_id] = (template["image_stamp"], classify_blank_frame(temp_img))
+        self.template_blank_kinds = template_blank_kinds
+
+    def update_popcount_threshold(self):
+        """
+        Calibrates the popcount threshold on the template images if the popcount engine is used without a
+        configured popcount_min_match_val.
+        """
+        if self.score_engine != "popcount" or self.popcount_min_match_val is not None:
+            return
+        self.popcount_threshold = self.calibrate_popcount_threshold()["threshold"]
+        if self.popcount_threshold is None:
+            print("No popcount threshold could be calibrated on the template images, features are scored with NCC")
+        else:
+            print(f"Calibrated popcount threshold: {self.popcount_threshold:.4f}")
+
+    def classify_blank_frame(self, img):
+        """
+        Returns the blank frame kind of an input image ("black", "no_signal" or "screensaver"), or None if it has
+        screen content or its kind is shown by one of the template images.
+        """
+        kind = classify_blank_frame(img)
+        if kind is None or any(kind == template_kind for _, template_kind in self.template_blank_kinds.values()):
+            return None
+        return kind
+
+    def build_template_cache(self):
+        """
+        Builds the cache of pre-filtered template feature crops for all templates in the configuration.
+
+        Returns:
+        - dict: {temp_img_id: {"size": dict, "features": {merkma_id: {"rect": tuple, "filtered_template": ndarray or None}}}}
+        """
+        template_cache = {}
+        for temp_img_id, temp_img_data in self.mde_config_data.get("images", {}).items():
+            template_cache[temp_img_id] = self.build_template_entry(temp_img_data)
+        self.roi_index = self.build_roi_index(template_cache)
+        return template_cache
+
+    def filter_template_features(self, temp_img_path, rects):
+        """
+        Loads a template image and filters the crop of each feature rectangle.
+
+        Parameters:
+        - temp_img_path (str): Path of the template image.
+        - rects (dict): {merkma_id: (x1, y1, x2, y2)}
+
+        Returns:
+        - list or None: The filtered crop of each rectangle (None for crops that could not be filtered), or None if the
+          template image could not be loaded.
+        """
+        temp_img = cv2.imread(temp_img_path)
+        if temp_img is None:
+            print(f"Failed to load template image: {temp_img_path}")
+            return None
+
+        try:
+            crops = prepare_crops_for_ocr(temp_img, list(rects.values()))
+        except cv2.error as cv2_error:
+            print(f"OpenCV Error while filtering the features of {temp_img_path}: {cv2_error}")
+            return [None] * len(rects)
+        for merkma_id, filtered_cropped_template_img in zip(rects, crops):
+            if filtered_cropped_template_img is None:
+                print(f"Empty feature region {merkma_id} of {temp_img_path}")
+        return crops
+
+    @staticmethod
+    def build_roi_index(template_cache):
+        """
+        Indexes the unique feature regions of all templates.
+
+        Returns:
+        - dict: {(size_key, rect): [(temp_img_id, merkma_id), ...]} for every unique region.
+        """
+        roi_index = {}
+        for temp_img_id, template in template_cache.items():
+            for merkma_id, feature in template["features"].items():
+                roi_index.setdefault((template["size_key"], feature["rect"]), []).append((temp_img_id, merkma_id))
+        return roi_index
+
+    def build_template_entry(self, temp_img_data, previous_entry=None):
+        """
+        Loads a template image once and filters the crop of each of its features.
+
+        Parameters:
+        - temp_img_data (dict): The template entry from mde_config.json.
+        - previous_entry (dict, optional): The cached entry of the same template. If its image is unchanged, the
+          filtered crops of its feature rectangles are reused and only new rectangles are filtered.
+
+        Returns:
+        - dict: The cached template entry. A feature whose crop could not be filtered has filtered_template None.
+        """
+        temp_img_path = os.path.join(self.templates_dir, temp_img_data.get("path", ""))
+        image_stamp = self.get_image_stamp(temp_img_path)
+        rects = {}
+        for merkma_id, feature in temp_img_data.get("features", {}).items():
+            position = feature.get("position", {})
+            x1, x2 = int(position.get("x1", 0)), int(position.get("x2", 0))
+            y1, y2 = int(position.get("y1", 0)), int(position.get("y2", 0))
+            rects[merkma_id] = (x1, y1, x2, y2)
+
+        known_crops = {}
+        if (previous_entry is not None and image_stamp is not None
+                and (previous_entry["path"], previous_entry["image_stamp"]) == (temp_img_data.get("path", ""), image_stamp)):
+            known_crops = {feature["rect"]: feature["filtered_template"]
+                           for feature in previous_entry["features"].values()}
+
+        crops = None
+        if all(rect in known_crops for rect in rects.values()):
+            crops = [known_crops[rect] for rect in rects.values()]
+        elif self.feature_cache is not None:
+            # Filtered crops of an unchanged template image are loaded from the on-disk cache
+            crops = self.feature_cache.load(temp_img_path, list(rects.values()))
+        if crops is None:
+            new_rects = {merkma_id: rect for merkma_id, rect in rects.items() if rect not in known_crops}
+            new_crops = self.filter_template_features(temp_img_path, new_rects)
+            if new_crops is not None:
+                known_crops.update(zip(new_rects.values(), new_crops))
+                crops = [known_crops[rect] for rect in rects.values()]
+                if self.feature_cache is not None:
+                    self.feature_cache.save(temp_img_path, list(rects.values()), crops)
+        if crops is None:
+            crops = [None] * len(rects)
+
+        features = {}
+        for (merkma_id, rect), filtered_cropped_template_img in zip(rects.items(), crops):
+            features[merkma_id] = {
+                "rect": rect,
+                "filtered_template": filtered_cropped_template_img,
+                "packed_template": self.pack_binary_image(filtered_cropped_template_img),
+            }
+
+        size = temp_img_data.get("size", (0, 0))
+        return {"path": temp_img_data.get("path", ""), "image_stamp": image_stamp, "size": size,
+                "size_key": self.get_size_key(size), "features": features}
+
+    @staticmethod
+    def get_image_stamp(img_path):
+        """
+        Returns (modification time in ns, file size) of an image, or None if it does not exist.
+        """
+        try:
+            stat = os.stat(img_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def get_size_key(size):
+        """
+        Returns a hashable key for a template size, used to group templates that share the same target size.
+        """
+        if isinstance(size, dict):
+            return size.get("width"), size.get("height")
+        return None
+
+    def resize_input_to_template(self, img, size, buffers=None):
+        """
+        Resizes the input image to a template size and converts it to grayscale.
+
+        Parameters:
+        - img (ndarray): The input image (BGR).
+        - size (dict): The template size {"width": int, "height": int}.
+        - buffers (BufferLease, optional): Source of the resized and grayscale images.
+
+        Returns:
+        - ndarray or None: The resized grayscale image, or None if resizing failed.
+        """
+        resized_buffer = gray_buffer = None
+        if buffers is not None and isinstance(size, dict):
+            target_shape = (size.get("height"), size.get("width"))
+            if img.shape[:2] != target_shape:
+                resized_buffer = buffers.get(target_shape + img.shape[2:])
+            if len(img.shape) == 3:
+                gray_buffer = buffers.get(target_shape)
+        img_resized = resize_image_cv2(img, size, out=resized_buffer)
+        if img_resized is None:
+            return None
+        return convert_to_grayscale(img_resized, out=gray_buffer)
+
+    def get_input_crop(self, img, template, rect, frame_inputs):
+        """
+        Returns the grayscale crop of the input image at a feature rectangle, in the template's coordinates.
+
+        Parameters:
+        - img (ndarray): The input image (BGR).
+        - template (dict): The cached template entry.
+        - rect (tuple): The feature rectangle (x1, y1, x2, y2) in template coordinates.
+        - frame_inputs (dict): Per-frame cache of the resized inputs and the filtered input crops.
+
+        Returns:
+        - ndarray or None: The cropped grayscale image, or None if resizing failed.
+        """
+        x1, y1, x2, y2 = rect
+
+        if self.resizes_crops(img, template):
+            # Resize only the feature region of the input image
+            cropped_img = resize_crop_cv2(img, template["size"], x1, y1, x2, y2)
+            if cropped_img is None:
+                return None
+            return convert_to_grayscale(cropped_img)
+
+        img_resized = self.get_resized_input(img, template, frame_inputs)
+        if img_resized is None:
+            return None
+        return img_resized[y1:y2, x1:x2]
+
+    def resizes_crops(self, img, template):
+        """
+        Checks whether the feature crops of a template are resized from the input image one by one
+        (crop_before_resize), which is only done when the input is scaled down to the template size.
+        """
+        return self.crop_before_resize and isinstance(template["size"], dict) and is_downscaling(img, template["size"])
+
+    def get_resized_input(self, img, template, frame_inputs):
+        """
+        Returns the input image resized to a template's size and converted to grayscale, once per distinct size and
+        frame.
+
+        Returns:
+        - ndarray or None: The resized grayscale image, or None if resizing failed.
+        """
+        resized_key = ("resized", template["size_key"])
+        img_resized = frame_inputs.get(resized_key)
+        if img_resized is None:
+            with self._resize_lock:
+                img_resized = frame_inputs.get(resized_key)
+                if img_resized is None:
+                    img_resized = self.resize_input_to_template(img, template["size"], frame_inputs.get("buffers"))
+                    if img_resized is None:
+                        return None
+                    frame_inputs[resized_key] = img_resized
+        return img_resized
+
+    def get_filtered_input_crop(self, img, template, rect, frame_inputs):
+        """
+        Returns the filtered input crop of a feature region. Templates often share feature regions, so every
+        unique region (template size and rectangle, see roi_index) is cropped and filtered only once per frame.
+
+        Returns:
+        - tuple: (resized, filtered_cropped_img). resized is False if the input image could not be resized.
+        """
+        filtered_key = ("filtered", template["size_key"], rect)
+        if filtered_key in frame_inputs:
+            return True, frame_inputs[filtered_key]
+
+        cropped_img = self.get_input_crop(img, template, rect, frame_inputs)
+        if cropped_img is None:
+            return False, None
+
+        # Concurrent evaluations of the same region compute the same result, keep the first one
+        filtered_cropped_img = frame_inputs.setdefault(
+            filtered_key, mde_img_filter(cropped_img, buffers=frame_inputs.get("buffers"))
+        )
+        return True, filtered_cropped_img
+
+    def prefilter_input_crops(self, img, templates, frame_inputs):
+        """
+        Filters the input crops of all feature regions of the given templates that are not filtered yet, with one
+        prepare_crops_for_ocr call per template size. The results go into frame_inputs, where
+        get_filtered_input_crop finds them; regions that fail here are left to it.
+        """
+        size_groups = {}
+        for _, template in templates:
+            if template["size_key"] is None:
+                continue
+            rects = size_groups.setdefault(template["size_key"], (template, {}))[1]
+            for feature in template["features"].values():
+                filtered_key = ("filtered", template["size_key"], feature["rect"])
+                if feature["filtered_template"] is not None and filtered_key not in frame_inputs:
+                    rects[filtered_key] = feature["rect"]
+
+        for template, rects in size_groups.values():
+            if not rects:
+                continue
+            if self.resizes_crops(img, template):
+                # The crops are resized from the input image one by one
+                source, new_size = img, template["size"]
+            else:
+                source, new_size = self.get_resized_input(img, template, frame_inputs), None
+                if source is None:
+                    continue
+            filtered_crops = prepare_crops_for_ocr(source, list(rects.values()), new_size=new_size,
+                                                   buffers=frame_inputs.get("buffers"), executor=self.executor)
+            for filtered_key, filtered_cropped_img in zip(rects, filtered_crops):
+                if filtered_cropped_img is not None:
+                    frame_inputs.setdefault(filtered_key, filtered_cropped_img)
+
     def load_mde_config_data(self, json_file_path):
         try:
             with open(json_file_path, 'r') as file:
@@ -72,68 +590,327 @@ class ImageMatcher:
             print(e)
             return {}
 
-    def match_images(self, img, min_match_val=0.9): 
+    def match_images(self, img, min_match_val=0.9, template_ids=None): 
         """
         Matches the input image against stored templates and identifies the best match.
+        Templates are evaluated in configuration order and the first template whose features all match wins,
+        also when the templates are evaluated concurrently on the thread pool.
+
+        Parameters:
+        - img (ndarray): The input image to be matched.
+        - min_match_val (float): Minimum similarity score required for a match.
+        - template_ids (list, optional): IDs of the templates to test, in the order they are tested.
+          Defaults to all templates in configuration order.
+
+        Returns:
+        - tuple: (match_values, temp_img_id) if a match is found, (kind, -1) for a blank frame found by
+          blank_frame_check (kind is "black", "no_signal" or "screensaver"), (-1, -1) if no match.
+        """
+        if self.blank_frame_check and not self.diagnostic:
+            # Blank screens are recognised from a small histogram and never pay for the template matching
+            blank_kind = self.classify_blank_frame(img)
+            if blank_kind is not None:
+                with self._stats_lock:
+                    self.blank_stats[blank_kind] += 1
+                return blank_kind, -1
+
+        if self.result_cache_size <= 0 or self.diagnostic:
+            return self.match_images_uncached(img, min_match_val, template_ids)
+
+        key = self.get_result_cache_key(img, min_match_val, template_ids)
+        # A CRC can collide, so a hit must also agree on a sample of the pixels
+        sample = self.get_result_cache_sample(img)
+        result = None
+        with self._result_cache_lock:
+            entry = self.result_cache.get(key)
+            if entry is not None and np.array_equal(entry[1], sample):
+                result = entry[0]
+                self.result_cache.move_to_end(key)
+                self.result_cache_stats["hits"] += 1
+            else:
+                self.result_cache_stats["misses"] += 1
+        if result is None:
+            result = self.match_images_uncached(img, min_match_val, template_ids)
+            with self._result_cache_lock:
+                # Results of a configuration that changed while matching are not stored
+                if key[3] == self.config_version:
+                    self.result_cache[key] = (result, sample)
+                    if len(self.result_cache) > self.result_cache_size:
+                        self.result_cache.popitem(last=False)
+                        self.result_cache_stats["evictions"] += 1
+        match_values, temp_img_id = result
+        # Callers get their own copy of the match values
+        return (list(match_values) if isinstance(match_values, list) else match_values), temp_img_id
+
+    def match_many(self, paths, min_match_val=0.9):
+        """
+        Matches image files one after another and yields one result per file, in the given order.
+
+        Parameters:
+        - paths (iterable): Paths of the image files.
+        - min_match_val (float): Minimum similarity score required for a match.
+
+        Yields:
+        - dict: {"path", "temp_img_id" (None if no template matches), "feature_scores" ({merkma_id: score} of the
+          matched template), "blank_kind" (see blank_frame_check, None for other frames), "decode_ms", "match_ms",
+          "error" (None, or why the file could not be matched)}
+        """
+        for path in paths:
+            result = {"path": path, "temp_img_id": None, "feature_scores": {}, "blank_kind": None, "decode_ms": 0.0,
+                      "match_ms": 0.0, "error": None}
+            start = time.perf_counter()
+            img = cv2.imread(path)
+            decoded = time.perf_counter()
+            result["decode_ms"] = (decoded - start) * 1000
+            if img is None:
+                result["error"] = "could not read image"
+                yield result
+                continue
+
+            match_values, temp_img_id = self.match_images(img, min_match_val)
+            result["match_ms"] = (time.perf_counter() - decoded) * 1000
+            if temp_img_id != -1:
+                result["temp_img_id"] = temp_img_id
+                feature_ids = self.template_cache[temp_img_id]["features"] if temp_img_id in self.template_cache else []
+                result["feature_scores"] = {merkma_id: float(match_val)
+                                            for merkma_id, match_val in zip(feature_ids, match_values)}
+            elif isinstance(match_values, str):
+                result["blank_kind"] = match_values
+            yield result
+
+    def get_result_cache_key(self, img, min_match_val, template_ids):
+        """
+        Returns the result cache key of a frame: a CRC32 of its pixels, its shape and dtype, the configuration
+        version, the threshold and the tested templates. CRC32 is about twice as fast as a cryptographic digest,
+        which would cost more than matching a small configuration.
+        """
+        img = np.ascontiguousarray(img)
+        digest = zlib.crc32(img.data)
+        return (digest, img.shape, img.dtype.str, self.config_version, min_match_val,
+                None if template_ids is None else tuple(template_ids))
+
+    @staticmethod
+    def get_result_cache_sample(img):
+        """
+        Returns every 16th pixel of every 16th row of a frame, stored with a cached result to rule out CRC collisions.
+        """
+        return img[::16, ::16].copy()
+
+    def match_images_uncached(self, img, min_match_val=0.9, template_ids=None):
+        """
+        Matches the input image like match_images, without the result cache.
+        """
+        # Inputs of this frame shared by all templates: one resized grayscale input per distinct template size
+        # and one filtered crop per unique feature region, filtered in buffers of the pool that are reused by the next
+        # frames
+        frame_inputs = {"buffers": self.buffer_pool.lease()} if self.buffer_pool is not None else {}
+        try:
+            if template_ids is None:
+                if self.classifier == "tree":
+                    return self.match_with_decision_tree(img, min_match_val, frame_inputs)
+                if self.hash_index is not None:
+                    return self.match_with_hash_index(img, min_match_val, frame_inputs)
+                templates = list(self.template_cache.items())
+            else:
+                templates = [(temp_img_id, self.template_cache[temp_img_id])
+                             for temp_img_id in template_ids if temp_img_id in self.template_cache]
+            return self.match_template_list(img, min_match_val, templates, frame_inputs)
+        finally:
+            if "buffers" in frame_inputs:
+                frame_inputs["buffers"].release()
+
+    def match_template_list(self, img, min_match_val, templates, frame_inputs):
+        """
+        Matches the input image against the given templates, the first matching template in the given order wins.
 
         Parameters:
         - img (ndarray): The input image to be matched.
         - min_match_val (float): Minimum similarity score required for a match.
+        - templates (list): (temp_img_id, cached template entry) pairs in the order they are tested.
+        - frame_inputs (dict): Per-frame cache of the resized inputs and the filtered input crops.
 
         Returns:
         - tuple: (match_values, temp_img_id) if a match is found, (-1, -1) if no match.
         """
+        # Per-feature scores of all templates, only collected in diagnostic mode
+        feature_scores = {} if self.diagnostic else None
 
-        # Loop through all image templates
-        for temp_img_id, temp_img_data in self.mde_config_data.get("images", {}).items():     
-            temp_img_path = os.path.join(self.templates_dir, temp_img_data["path"])   
-            match_values = []
-            features_count = 0
-            match_count = 0
-
-            # Loop through all features in the current template image
-            for merkma_id, feature in temp_img_data.get("features", {}).items(): 
-                features_count += 1
-                position = feature.get("position", {})
-                x1, x2 = int(position.get("x1", 0)), int(position.get("x2", 0))
-                y1, y2 = int(position.get("y1", 0)), int(position.get("y2", 0))
-
-                temp_img = cv2.imread(temp_img_path)
-                if temp_img is None:
-                    print(f"Failed to load template image: {temp_img_path}")
-                    continue  # Skip to next feature
-
-                # Resize the input image to match the template's size
-                img_resized = resize_image_cv2(img, temp_img_data.get("size", (0, 0)))
-                if img_resized is None:
-                    print("Failed to resize input image.")
-                    return -1, -1  # Exit if resizing fails
+        if self.batch_scoring:
+            # Filter all features first, then score the equal-sized crops of the frame in one batch
+            results = self.evaluate_templates_batched(img, templates, min_match_val, frame_inputs, feature_scores)
+            if self.diagnostic:
+                self.last_feature_scores = feature_scores
+            return self.first_matching_template(results)
 
-                # Crop the resized input image and the template image based on feature position
-                cropped_img = img_resized[y1:y2, x1:x2] 
-                cropped_temp = temp_img[y1:y2, x1:x2] 
+        if self.executor is None:
+            # Loop through all cached image templates
+            results = (
+                (temp_img_id, self.evaluate_template(temp_img_id, img, template, min_match_val, frame_inputs,
+                                                     feature_scores=feature_scores))
+                for temp_img_id, template in templates
+            )
+            if self.diagnostic:
+                # Diagnostic mode scores every template, not only those up to the first match
+                results = list(results)
+                self.last_feature_scores = feature_scores
+            return self.first_matching_template(results)
 
-                # Apply image preprocessing/filtering
-                filtered_cropped_template_img = mde_img_filter(cropped_temp)
-                filtered_cropped_img = mde_img_filter(cropped_img)
-                
-                # Check if cropping was successful
-                if filtered_cropped_img is None or filtered_cropped_template_img is None:
-                    print("Image filtering failed for one of the cropped images.")
-                    continue  # Skip to next feature
-
-                # Compute match value
-                match_val = self.compute_match_value(filtered_cropped_img, filtered_cropped_template_img)
-
-                if match_val is not None:
-                    match_values.append(match_val)
-                    if match_val >= min_match_val:
-                        match_count += 1
-                else:
-                    print(f"Skipping feature {merkma_id} due to matching issues.")
+        # Evaluate all templates concurrently, then collect the results in configuration order
+        stop_event = None if self.diagnostic else threading.Event()
+        futures = [
+            (temp_img_id, self.executor.submit(self.evaluate_template, temp_img_id, img, template, min_match_val,
+                                               frame_inputs, stop_event, feature_scores))
+            for temp_img_id, template in templates
+        ]
+        try:
+            results = ((temp_img_id, future.result()) for temp_img_id, future in futures)
+            if self.diagnostic:
+                results = list(results)
+                self.last_feature_scores = feature_scores
+            return self.first_matching_template(results)
+        finally:
+            # The result is decided, templates later in the order are no longer needed
+            if stop_event is not None:
+                stop_event.set()
+            for _, future in futures:
+                future.cancel()
+            # Evaluations still running stop at their next feature; they must be done before the frame's buffers are reused
+            wait([future for _, future in futures])
 
-            # Check if all features matched
-            if match_count == features_count and features_count > 0:
+    def match_with_decision_tree(self, img, min_match_val, frame_inputs=None):
+        """
+        Classifies the input image with the decision tree compiled from the templates and fully verifies only the
+        templates of the reached leaf. If none of them matches, the remaining templates are tested in configuration
+        order, unless candidate_fallback is disabled.
+
+        Returns:
+        - tuple: (match_values, temp_img_id) if a match is found, (-1, -1) if no match.
+        """
+        tree = self.get_decision_tree(min_match_val)
+        frame_inputs = {} if frame_inputs is None else frame_inputs
+        candidates, tests_run = classify(
+            tree, lambda feature_test: self.test_feature(img, *feature_test, min_match_val, frame_inputs)
+        )
+        with self._stats_lock:
+            self.tree_stats["frames"] += 1
+            self.tree_stats["feature_tests"] += tests_run
+
+        return self.verify_candidates(img, min_match_val, candidates or [], frame_inputs, self.tree_stats)
+
+    def match_with_hash_index(self, img, min_match_val, frame_inputs=None):
+        """
+        Shortlists the hash_shortlist templates whose image hash is closest to the hash of the input image and fully
+        verifies only those. If none of them matches, the remaining templates are tested in configuration order,
+        unless candidate_fallback is disabled.
+
+        Returns:
+        - tuple: (match_values, temp_img_id) if a match is found, (-1, -1) if no match.
+        """
+        frame_hash = dhash_image(img, self.hash_index.hash_size)
+        with self._stats_lock:
+            self.hash_stats["frames"] += 1
+        if frame_hash is None:
+            return -1, -1
+        shortlist = {temp_img_id for temp_img_id, _ in
+                     self.hash_index.query(frame_hash, self.hash_shortlist, list(self.template_cache))}
+        # Verify the shortlist in configuration order, so the first matching template still wins
+        candidates = [temp_img_id for temp_img_id in self.template_cache if temp_img_id in shortlist]
+        return self.verify_candidates(img, min_match_val, candidates, {} if frame_inputs is None else frame_inputs,
+                                      self.hash_stats)
+
+    def verify_candidates(self, img, min_match_val, candidates, frame_inputs, stats):
+        """
+        Fully matches the shortlisted candidate templates, then the remaining templates if none of them matches and
+        candidate_fallback is enabled.
+
+        Parameters:
+        - candidates (list): IDs of the shortlisted templates, in the order they are tested.
+        - frame_inputs (dict): Per-frame cache of the resized inputs and the filtered input crops.
+        - stats (dict): Statistics whose "fallbacks" counter is incremented when the remaining templates are tested.
+
+        Returns:
+        - tuple: (match_values, temp_img_id) if a match is found, (-1, -1) if no match.
+        """
+        templates = [(temp_img_id, self.template_cache[temp_img_id]) for temp_img_id in candidates]
+        match_values, temp_img_id = self.match_template_list(img, min_match_val, templates, frame_inputs)
+        if temp_img_id != -1 or not self.candidate_fallback:
+            return match_values, temp_img_id
+
+        with self._stats_lock:
+            stats["fallbacks"] += 1
+        remaining_templates = [(temp_img_id, template) for temp_img_id, template in self.template_cache.items()
+                               if temp_img_id not in candidates]
+        return self.match_template_list(img, min_match_val, remaining_templates, frame_inputs)
+
+    def get_decision_tree(self, min_match_val):
+        """
+        Returns the decision tree for min_match_val, compiling it if the templates or the threshold changed.
+        """
+        with self._tree_lock:
+            if self.decision_tree is None or self.decision_tree_min_match_val != min_match_val:
+                self.decision_tree = self.compile_decision_tree(min_match_val)
+                self.decision_tree_min_match_val = min_match_val
+            return self.decision_tree
+
+    def compile_decision_tree(self, min_match_val):
+        """
+        Compiles the decision tree over the templates. The expected outcome of every feature test on every template's
+        screen is measured on the template images. Templates that can never match (no features, or a feature that
+        could not be loaded) are left out of the tree.
+
+        Returns:
+        - dict: The root node of the tree, see template_decision_tree.compile_decision_tree.
+        """
+        template_ids = [
+            temp_img_id for temp_img_id, template in self.template_cache.items()
+            if template["features"] and all(feature["filtered_template"] is not None
+                                            for feature in template["features"].values())
+        ]
+        feature_tests = [(temp_img_id, merkma_id)
+                         for temp_img_id in template_ids for merkma_id in self.template_cache[temp_img_id]["features"]]
+
+        # Run every feature test on the screen of every template
+        outcomes = {feature_test: {} for feature_test in feature_tests}
+        for template_id in template_ids:
+            temp_img = cv2.imread(os.path.join(self.templates_dir, self.template_cache[template_id]["path"]))
+            frame_inputs = {}
+            for feature_test in feature_tests:
+                outcomes[feature_test][template_id] = bool(
+                    temp_img is not None and self.test_feature(temp_img, *feature_test, min_match_val, frame_inputs)
+                )
+
+        return compile_decision_tree(template_ids, feature_tests, outcomes)
+
+    def test_feature(self, img, temp_img_id, merkma_id, min_match_val, frame_inputs):
+        """
+        Tests a single template feature on the input image.
+
+        Returns:
+        - bool or None: True if the feature matches, False if not, None if the input image could not be resized.
+        """
+        template = self.template_cache[temp_img_id]
+        feature = template["features"][merkma_id]
+        if feature["filtered_template"] is None:
+            return False
+        resized, filtered_cropped_img = self.get_filtered_input_crop(img, template, feature["rect"], frame_inputs)
+        if not resized:
+            return None
+        if filtered_cropped_img is None:
+            return False
+        match_val, feature_min_match_val = self.score_feature(filtered_cropped_img, feature, min_match_val)
+        return match_val is not None and match_val >= feature_min_match_val
+
+    def first_matching_template(self, results):
+        """
+        Returns the first matching template from (temp_img_id, evaluation result) pairs in configuration order.
+
+        Returns:
+        - tuple: (match_values, temp_img_id) if a match is found, (-1, -1) if no match or resizing failed.
+        """
+        for temp_img_id, (status, match_values) in results:
+            if status == "resize_failed":
+                return -1, -1  # Exit if resizing fails
+            if status == "matched":
                 print('*********************************************')
                 print('Current match_values')
                 print(f" match_values = {match_values}    temp_img_id = {temp_img_id}")
@@ -143,6 +920,183 @@ class ImageMatcher:
         # If no templates matched
         return -1, -1
 
+    def evaluate_template(self, temp_img_id, img, template, min_match_val, frame_inputs, stop_event=None, feature_scores=None):
+        """
+        Compares the input image with the features of one cached template as a cascade: the template is rejected at
+        its first failing feature, and the features that rejected most often so far are tested first.
+        In diagnostic mode all features are computed and their scores are stored in feature_scores.
+
+        Parameters:
+        - temp_img_id (str): The ID of the template.
+        - img (ndarray): The input image to be matched.
+        - template (dict): The cached template entry.
+        - min_match_val (float): Minimum similarity score required for a feature match.
+        - frame_inputs (dict): Per-frame cache of the resized inputs and the filtered input crops.
+        - stop_event (threading.Event, optional): Set when the result of this template is no longer needed.
+        - feature_scores (dict, optional): Receives {temp_img_id: {merkma_id: match_val}} in diagnostic mode.
+
+        Returns:
+        - tuple: (status, match_values) where status is "matched", "not_matched", "resize_failed" or "stopped".
+          match_values are listed in configuration order.
+        """
+        scores = {}
+        if feature_scores is not None:
+            feature_scores[temp_img_id] = scores
+        all_matched = len(template["features"]) > 0
+
+        # Loop through the features of the current template image, most discriminative first
+        for merkma_id in self.get_feature_order(temp_img_id, template):
+            if stop_event is not None and stop_event.is_set():
+                return "stopped", []
+            feature = template["features"][merkma_id]
+
+            filtered_cropped_template_img = feature["filtered_template"]
+            if filtered_cropped_template_img is None:
+                # Template could not be loaded or filtered, this feature can never match
+                all_matched = False
+                if not self.diagnostic:
+                    break
+                continue
+
+            # Crop the input image at the feature position in template coordinates and apply image preprocessing/filtering
+            resized, filtered_cropped_img = self.get_filtered_input_crop(img, template, feature["rect"], frame_inputs)
+            if not resized:
+                print("Failed to resize input image.")
+                return "resize_failed", []
+
+            # Check if filtering was successful and compute match value
+            if filtered_cropped_img is None:
+                print("Image filtering failed for the cropped input image.")
+                match_val, feature_min_match_val = None, min_match_val
+            else:
+                match_val, feature_min_match_val = self.score_feature(filtered_cropped_img, feature, min_match_val)
+                if match_val is None:
+                    print(f"Skipping feature {merkma_id} due to matching issues.")
+
+            feature_matched = match_val is not None and match_val >= feature_min_match_val
+            self.update_feature_stats(temp_img_id, merkma_id, feature_matched)
+            if match_val is not None:
+                scores[merkma_id] = match_val
+
+            if not feature_matched:
+                all_matched = False
+                if not self.diagnostic:
+                    break  # The template can no longer match
+
+        # Report the match values in configuration order
+        match_values = [scores[merkma_id] for merkma_id in template["features"] if merkma_id in scores]
+        if all_matched:
+            return "matched", match_values
+        return "not_matched", match_values
+
+    def evaluate_templates_batched(self, img, templates, min_match_val, frame_inputs, feature_scores=None):
+        """
+        Compares the input image with all features of the given templates. The input crops of all features are
+        filtered first, then all crops with the shape of their template crop are scored at once with batched_ncc.
+        Crops of a different shape are scored with compute_match_value.
+
+        Parameters:
+        - img (ndarray): The input image to be matched.
+        - templates (list): (temp_img_id, cached template entry) pairs in the order they are tested.
+        - min_match_val (float): Minimum similarity score required for a feature match.
+        - frame_inputs (dict): Per-frame cache of the resized inputs and the filtered input crops.
+        - feature_scores (dict, optional): Receives {temp_img_id: {merkma_id: match_val}}.
+
+        Returns:
+        - list: (temp_img_id, (status, match_values)) pairs in the given order, up to the first template whose
+          input could not be resized.
+        """
+        # Filter the input crop of every feature, the crops of each template size in one batch
+        self.prefilter_input_crops(img, templates, frame_inputs)
+        filtered_crops = {}
+        evaluated_templates = []
+        resize_failed = False
+        for temp_img_id, template in templates:
+            evaluated_templates.append((temp_img_id, template))
+            for merkma_id, feature in template["features"].items():
+                if feature["filtered_template"] is None:
+                    continue  # Template could not be loaded or filtered, this feature can never match
+                resized, filtered_cropped_img = self.get_filtered_input_crop(img, template, feature["rect"], frame_inputs)
+                if not resized:
+                    print("Failed to resize input image.")
+                    resize_failed = True
+                    break
+                if filtered_cropped_img is not None:
+                    filtered_crops[(temp_img_id, merkma_id)] = (filtered_cropped_img, feature)
+            if resize_failed:
+                break  # Templates after this one are not reached
+
+        # Score all crops, the equal-sized NCC crops grouped by shape
+        scores = {}
+        ncc_groups = {}
+        for key, (filtered_cropped_img, feature) in filtered_crops.items():
+            if self.score_engine == "ncc" and filtered_cropped_img.shape == feature["filtered_template"].shape:
+                ncc_groups.setdefault(filtered_cropped_img.shape, []).append(key)
+            else:
+                scores[key] = self.score_feature(filtered_cropped_img, feature, min_match_val)
+        for keys in ncc_groups.values():
+            match_vals = batched_ncc(
+                np.stack([filtered_crops[key][0] for key in keys]),
+                np.stack([filtered_crops[key][1]["filtered_template"] for key in keys]),
+            )
+            for key, match_val in zip(keys, match_vals):
+                scores[key] = float(match_val), min_match_val
+
+        # Decide every template from its feature scores
+        results = []
+        for index, (temp_img_id, template) in enumerate(evaluated_templates):
+            if resize_failed and index == len(evaluated_templates) - 1:
+                results.append((temp_img_id, ("resize_failed", [])))
+                break
+            template_scores = {}
+            all_matched = len(template["features"]) > 0
+            for merkma_id in template["features"]:
+                match_val, feature_min_match_val = scores.get((temp_img_id, merkma_id), (None, min_match_val))
+                if match_val is None:
+                    all_matched = False
+                    continue
+                template_scores[merkma_id] = match_val
+                if match_val < feature_min_match_val:
+                    all_matched = False
+            if feature_scores is not None:
+                feature_scores[temp_img_id] = template_scores
+            results.append((temp_img_id, ("matched" if all_matched else "not_matched", list(template_scores.values()))))
+        return results
+
+    def get_feature_order(self, temp_img_id, template):
+        """
+        Returns the feature IDs of a template ordered by their measured rejection rate, highest first.
+        Features without statistics keep their configuration order.
+        """
+        stats = self.feature_stats.get(temp_img_id)
+        if not stats:
+            return list(template["features"])
+
+        def rejection_rate(merkma_id):
+            evaluations, rejections = stats.get(merkma_id, (0, 0))
+            # Laplace smoothing, so rarely evaluated features are neither preferred nor ignored
+            return (rejections + 1) / (evaluations + 2)
+
+        return sorted(template["features"], key=rejection_rate, reverse=True)
+
+    def update_feature_stats(self, temp_img_id, merkma_id, feature_matched):
+        """
+        Records the outcome of one feature test, used to order the features of the cascade.
+        """
+        with self._stats_lock:
+            stats = self.feature_stats.setdefault(temp_img_id, {}).setdefault(merkma_id, [0, 0])
+            stats[0] += 1
+            if not feature_matched:
+                stats[1] += 1
+
+    def close(self):
+        """
+        Shuts down the thread pool used for concurrent template evaluation.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
  
     '''    def match_images(self, img, min_match_val=0.9): 
         """
@@ -258,6 +1212,355 @@ class ImageMatcher:
 
 
 
+    def score_feature(self, filtered_cropped_img, feature, min_match_val):
+        """
+        Scores a filtered input crop against a cached template feature with the configured score engine.
+
+        Returns:
+        - tuple: (match_val, feature_min_match_val), the score and the minimum score for a match of that score.
+        """
+        if (self.score_engine == "popcount" and self.popcount_threshold is not None
+                and filtered_cropped_img.shape == feature["filtered_template"].shape):
+            match_val = self.compute_popcount_match_value(filtered_cropped_img, feature["packed_template"])
+            return match_val, self.popcount_threshold
+        return self.compute_match_value(filtered_cropped_img, feature["filtered_template"]), min_match_val
+
+    @staticmethod
+    def pack_binary_image(binary_img):
+        """
+        Packs the black pixels of a filtered (black and white) image into bits.
+
+        Returns:
+        - ndarray or None: The packed bits, or None if no image is given.
+        """
+        if binary_img is None:
+            return None
+        return np.packbits(binary_img < 128)
+
+    def compute_popcount_match_value(self, filtered_cropped_img, packed_template):
+        """
+        Computes the fraction of equal pixels of a filtered input crop and an equal-sized template crop, using XOR and
+        popcount on the bit-packed crops.
+
+        Returns:
+        - float: Similarity score between 0 and 1, where 1 indicates identical crops.
+        """
+        packed_img = self.pack_binary_image(filtered_cropped_img)
+        different_pixels = int(np.bitwise_count(np.bitwise_xor(packed_img, packed_template)).sum())
+        return 1.0 - different_pixels / filtered_cropped_img.size
+
+    def calibrate_popcount_threshold(self, frames=None, min_match_val=0.9):
+        """
+        Calibrates the popcount threshold against the NCC score. Every feature of every template is scored on the
+        given frames with both engines, and the popcount threshold that best reproduces the NCC decisions
+        (NCC score >= min_match_val) is chosen.
+
+        Parameters:
+        - frames (list, optional): Input images. Defaults to the template images and copies of them scaled to 1920x1080.
+        - min_match_val (float): The NCC threshold to reproduce.
+
+        Returns:
+        - dict: {"threshold": float or None, "agreement": float, "pairs": int, "ncc_matches": int}
+        """
+        if frames is None:
+            frames = []
+            for temp_img_data in self.mde_config_data.get("images", {}).values():
+                temp_img = cv2.imread(os.path.join(self.templates_dir, temp_img_data.get("path", "")))
+                if temp_img is not None:
+                    frames.extend([temp_img, cv2.resize(temp_img, (1920, 1080))])
+
+        # Collect (ncc score, popcount score) pairs of all equal-sized crops
+        pairs = []
+        for img in frames:
+            frame_inputs = {}
+            for template in self.template_cache.values():
+                for feature in template["features"].values():
+                    if feature["filtered_template"] is None:
+                        continue
+                    resized, filtered_cropped_img = self.get_filtered_input_crop(img, template, feature["rect"], frame_inputs)
+                    if not resized or filtered_cropped_img is None:
+                        continue
+                    if filtered_cropped_img.shape != feature["filtered_template"].shape:
+                        continue
+                    ncc_val = self.compute_match_value(filtered_cropped_img, feature["filtered_template"])
+                    if ncc_val is not None:
+                        pairs.append((ncc_val, self.compute_popcount_match_value(filtered_cropped_img, feature["packed_template"])))
+
+        if not pairs:
+            return {"threshold": None, "agreement": 0.0, "pairs": 0, "ncc_matches": 0}
+
+        # Try every popcount score as threshold and keep the highest one with the best agreement
+        candidates = sorted({popcount_val for _, popcount_val in pairs}, reverse=True)
+        best_index, best_agreement = 0, -1
+        for index, candidate in enumerate(candidates):
+            agreement = sum((ncc_val >= min_match_val) == (popcount_val >= candidate) for ncc_val, popcount_val in pairs)
+            if agreement > best_agreement:
+                best_index, best_agreement = index, agreement
+
+        # Any threshold between the chosen score and the next lower score decides the same, take the middle
+        best_threshold = candidates[best_index]
+        if best_index + 1 < len(candidates):
+            best_threshold = (best_threshold + candidates[best_index + 1]) / 2
+
+        return {
+            "threshold": best_threshold,
+            "agreement": best_agreement / len(pairs),
+            "pairs": len(pairs),
+            "ncc_matches": sum(ncc_val >= min_match_val for ncc_val, _ in pairs),
+        }
+
+
+def batched_ncc(images, templates):
+    """
+    Computes the normalized cross-correlation of equal-sized image/template pairs at once, like
+    cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED) computes it for an image of the template's size.
+
+    Parameters:
+    - images (ndarray): Stack of n grayscale images, shape (n, height, width).
+    - templates (ndarray): Stack of n grayscale templates of the same shape.
+
+    Returns:
+    - ndarray: The n similarity scores between -1 and 1.
+    """
+    images = images.reshape(len(images), -1).astype(np.float64)
+    templates = templates.reshape(len(templates), -1).astype(np.float64)
+    images -= images.mean(axis=1, keepdims=True)
+    templates -= templates.mean(axis=1, keepdims=True)
+
+    numerator = np.einsum("ij,ij->i", images, templates)
+    denominator = np.sqrt(np.einsum("ij,ij->i", images, images) * np.einsum("ij,ij->i", templates, templates))
+
+    # Same handling of (nearly) constant crops as cv2.matchTemplate: a constant template scores 1, a constant image 0
+    scores = np.zeros(len(images))
+    regular = np.abs(numerator) < denominator
+    scores[regular] = numerator[regular] / denominator[regular]
+    saturated = ~regular & (np.abs(numerator) < denominator * 1.125)
+    scores[saturated] = np.sign(numerator[saturated])
+    scores[~templates.any(axis=1)] = 1.0
+    return scores
+
+
+class FrameChangeGate:
+    """
+    Cheap pre-check that tells whether a frame differs from the last matched frame.
+
+    Frames are reduced to a fingerprint, either a downsampled grayscale copy of the whole frame or the grayscale
+    crops of the feature regions only. A frame counts as unchanged when the mean absolute gray difference of every
+    fingerprint part to the reference fingerprint is at most change_threshold. The reference is only replaced when
+    a frame is matched again, so slow drifts over many frames are still detected.
+
+    Attributes:
+    - change_threshold (float): Largest mean absolute gray difference (0-255) of an unchanged frame.
+    - stats (dict): Counters of the checked frames, the unchanged (skipped) frames and the changed frames.
+    """
+    def __init__(self, change_threshold=2.0, fingerprint_size=(64, 48), rois=None):
+        """
+        Parameters:
+        - change_threshold (float): Largest mean absolute gray difference (0-255) of an unchanged frame.
+        - fingerprint_size (tuple): (width, height) of the downsampled frame fingerprint.
+        - rois (list, optional): ((x1, y1, x2, y2), size) regions in template coordinates. If given, only these
+          regions are compared instead of the whole frame.
+        """
+        self.change_threshold = change_threshold
+        self.fingerprint_size = fingerprint_size
+        self.rois = rois
+        self.reference = None
+        self.stats = {"frames": 0, "skipped": 0, "changed": 0}
+
+    def fingerprint(self, img):
+        """
+        Returns the fingerprint of a frame as a list of small grayscale images.
+        """
+        if self.rois is None:
+            small = cv2.resize(img, self.fingerprint_size, interpolation=cv2.INTER_AREA)
+            return [convert_to_grayscale(small)]
+
+        height, width = img.shape[:2]
+        parts = []
+        for (x1, y1, x2, y2), size in self.rois:
+            # Map the region from template coordinates into the input image
+            scale_x = width / size["width"]
+            scale_y = height / size["height"]
+            crop = img[int(y1 * scale_y):int(y2 * scale_y), int(x1 * scale_x):int(x2 * scale_x)]
+            parts.append(convert_to_grayscale(crop))
+        return parts
+
+    @staticmethod
+    def difference(fingerprint, reference):
+        """
+        Returns the largest mean absolute gray difference between the parts of two fingerprints.
+        """
+        if len(fingerprint) != len(reference):
+            return float("inf")
+        largest = 0.0
+        for part, reference_part in zip(fingerprint, reference):
+            if part.shape != reference_part.shape:
+                return float("inf")
+            if part.size:
+                largest = max(largest, cv2.absdiff(part, reference_part).mean())
+        return largest
+
+    def check(self, img):
+        """
+        Compares a frame with the reference fingerprint.
+
+        Returns:
+        - tuple: (changed, fingerprint). Pass the fingerprint to update_reference once the frame was matched.
+        """
+        self.stats["frames"] += 1
+        fingerprint = self.fingerprint(img)
+        changed = self.reference is None or self.difference(fingerprint, self.reference) > self.change_threshold
+        if changed:
+            self.stats["changed"] += 1
+        else:
+            self.stats["skipped"] += 1
+        return changed, fingerprint
+
+    def update_reference(self, fingerprint):
+        self.reference = fingerprint
+
+    def reset(self, rois=None):
+        """
+        Forgets the reference fingerprint, optionally with new regions to compare.
+        """
+        self.rois = rois
+        self.reference = None
+
+
+class MatcherSession:
+    """
+    Stateful matching session for a stream of screenshots from one machine.
+
+    Consecutive screenshots almost always show the same screen, so the session tests the last matched template
+    first and only falls back to the other templates when it fails. The remaining templates are tested in order
+    of how often they matched in this session, templates that never matched keep their configuration order.
+    Note that when several templates match the same frame, the session returns the one it tests first.
+
+    With a change_threshold, a FrameChangeGate compares every frame with the last matched frame and the previous
+    result is reused for frames that did not change.
+
+    The streaming paths (frame_stream.FrameStream.match, machine_scheduler.MachineScheduler and
+    runtime_pipeline.RuntimePipeline) create one session per stream from the [Session] section of config.ini
+    (see AppConfigManager.get_session_settings). A session may be called from several threads; the frames are then
+    matched one at a time.
+
+    Attributes:
+    - matcher (ImageMatcher): The matcher holding the templates.
+    - last_temp_img_id (str or None): The template matched by the last frame.
+    - hit_counts (dict): Number of matched frames per template ID.
+    - stats (dict): Counters of the frames, the matches of the last template, the fallback scans and the frames
+      skipped by the change gate.
+    - gate (FrameChangeGate or None): The frame-difference gate, if enabled.
+    """
+    def __init__(self, matcher, min_match_val=0.9, change_threshold=None, gate_mode="frame"):
+        """
+        Parameters:
+        - matcher (ImageMatcher): The matcher holding the templates.
+        - min_match_val (float): Minimum similarity score required for a match.
+        - change_threshold (float, optional): Largest mean absolute gray difference (0-255) of a frame that is
+          considered unchanged. None disables the change gate.
+        - gate_mode (str): "frame" compares a downsampled copy of the whole frame, "feature_rois" compares only the
+          feature regions of the templates.
+        """
+        self.matcher = matcher
+        self.min_match_val = min_match_val
+        self.last_temp_img_id = None
+        self.hit_counts = {}
+        self.stats = {"frames": 0, "last_template_hits": 0, "full_scans": 0, "gate_skips": 0}
+
+        self.gate_mode = gate_mode
+        self.gate = FrameChangeGate(change_threshold, rois=self.get_gate_rois()) if change_threshold is not None else None
+        self.last_result = None
+        self._lock = threading.Lock()
+
+    def get_gate_rois(self):
+        """
+        Returns the unique feature regions of all templates for the "feature_rois" gate mode, None otherwise.
+        """
+        if self.gate_mode != "feature_rois":
+            return None
+        return [
+            (rect, {"width": size_key[0], "height": size_key[1]})
+            for size_key, rect in self.matcher.roi_index if size_key is not None
+        ]
+
+    def get_template_order(self, exclude=None):
+        """
+        Returns the template IDs ordered by their number of matches in this session, highest first.
+        """
+        template_ids = [temp_img_id for temp_img_id in self.matcher.template_cache if temp_img_id != exclude]
+        return sorted(template_ids, key=lambda temp_img_id: self.hit_counts.get(temp_img_id, 0), reverse=True)
+
+    def match(self, img):
+        """
+        Matches the next frame of the stream.
+
+        Parameters:
+        - img (ndarray): The input image to be matched.
+
+        Returns:
+        - tuple: (match_values, temp_img_id) if a match is found, (-1, -1) if no match.
+        """
+        with self._lock:
+            return self.match_locked(img)
+
+    def match_locked(self, img):
+        self.stats["frames"] += 1
+
+        # Reuse the previous result if the frame did not change
+        fingerprint = None
+        if self.gate is not None:
+            changed, fingerprint = self.gate.check(img)
+            if not changed and self.last_result is not None:
+                self.stats["gate_skips"] += 1
+                return self.last_result
+
+        result = self.match_templates(img)
+        if self.gate is not None:
+            self.gate.update_reference(fingerprint)
+            self.last_result = result
+        return result
+
+    def match_templates(self, img):
+        """
+        Matches a frame against the templates, the last matched template first.
+        """
+        last_temp_img_id = self.last_temp_img_id
+
+        # Test the template of the previous frame first
+        if last_temp_img_id in self.matcher.template_cache:
+            match_values, temp_img_id = self.matcher.match_images(img, self.min_match_val, template_ids=[last_temp_img_id])
+            if isinstance(match_values, str):
+                # A blank frame, the other templates need not be tested
+                return match_values, temp_img_id
+            if temp_img_id != -1:
+                self.stats["last_template_hits"] += 1
+                self.hit_counts[temp_img_id] = self.hit_counts.get(temp_img_id, 0) + 1
+                return match_values, temp_img_id
+
+        # Fall back to the remaining templates, most frequently matched first
+        self.stats["full_scans"] += 1
+        match_values, temp_img_id = self.matcher.match_images(
+            img, self.min_match_val, template_ids=self.get_template_order(exclude=last_temp_img_id)
+        )
+        if temp_img_id != -1:
+            self.hit_counts[temp_img_id] = self.hit_counts.get(temp_img_id, 0) + 1
+            self.last_temp_img_id = temp_img_id
+        else:
+            self.last_temp_img_id = None
+        return match_values, temp_img_id
+
+    def reset(self):
+        """
+        Forgets the last matched template, the match counts and the last result, e.g. after the templates were changed.
+        """
+        with self._lock:
+            self.last_temp_img_id = None
+            self.hit_counts = {}
+            self.last_result = None
+            if self.gate is not None:
+                self.gate.reset(self.get_gate_rois())
+
 
 def main():
     """
@@ -0,0 +1,268 @@
+''' Asyncio runtime that chains the pieces of the application for live machine screens:
+ingest frames -> match the template -> extract and read the parameter regions -> evaluate the machine status.
+
+Every stage has its own bounded queue and number of workers. OpenCV work runs on a thread pool (OpenCV releases the
+GIL), so the event loop only moves frames between the stages. '''
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from Image_functions_v001 import prepare_crops_for_ocr
+from helpers import evaluate_machine_status, get_condition_parameters
+from pattern_detection_v001 import MatcherSession
+
+
+class RuntimePipeline:
+    """
+    Pipeline of the stages match, extract and status behind an ingest stage.
+
+    Each frame is a tuple (path, mtime_ns, image), as yielded by frame_stream.FrameStream. For every frame a result
+    dict is passed to on_result:
+    {"path", "mtime_ns", "temp_img_id" (None if no template matched), "match_values", "blank_kind" ("black",
+    "no_signal" or "screensaver" for blank frames, see ImageMatcher blank_frame_check), "parameters"
+    ({name: recognised value}), "status" (None if no condition holds, or if the parameters the conditions need could
+    not be read, e.g. without ocr_fn), "latency_ms"}.
+
+    Example:
+        pipeline = RuntimePipeline(matcher, ocr_fn=read_text, on_result=print)
+        with FrameStream("captures") as stream:
+            asyncio.run(pipeline.run(stream))
+    """
+    def __init__(self, matcher, ocr_fn=None, on_result=None, min_match_val=0.9, executor_workers=4,
+                 match_concurrency=2, match_queue_depth=4, extract_concurrency=2, extract_queue_depth=4,
+                 status_concurrency=1, status_queue_depth=8, session_settings=None):
+        """
+        Parameters:
+        - matcher (ImageMatcher): The matcher of the configured templates.
+        - ocr_fn (callable, optional): ocr_fn(filtered_crop, parameter_name) returns the text of a parameter region
+          preprocessed with prepare_crops_for_ocr. Without it, the parameter values and the status stay None.
+        - on_result (callable, optional): Called with the result dict of every frame, on the event loop.
+        - min_match_val (float): Minimum similarity score required for a match.
+        - executor_workers (int): Threads of the executor that runs matching, cropping and OCR.
+        - match_concurrency, extract_concurrency, status_concurrency (int): Workers of the match, extract and status
+          stages.
+        - match_queue_depth, extract_queue_depth, status_queue_depth (int): Frames waiting in front of each stage.
+          A full queue holds the stage before it back, down to the ingest stage.
+        - session_settings (dict, optional): Keyword arguments for the MatcherSession of the stream, see
+          AppConfigManager.get_session_settings(). The session matches the frames one at a time.
+        """
+        self.matcher = matcher
+        self.session = MatcherSession(matcher, min_match_val, **(session_settings or {}))
+        self.ocr_fn = ocr_fn
+        self.on_result = on_result
+        self.min_match_val = min_match_val
+        self.executor_workers = executor_workers
+        self.match_concurrency = match_concurrency
+        self.match_queue_depth = match_queue_depth
+        self.extract_concurrency = extract_concurrency
+        self.extract_queue_depth = extract_queue_depth
+        self.status_concurrency = status_concurrency
+        self.status_queue_depth = status_queue_depth
+        self.stats = {"ingested": 0, "matched": 0, "blank": 0, "unmatched": 0, "evaluated": 0, "status_unknown": 0,
+                      "errors": 0}
+        self.executor = None
+
+    async def run(self, frames):
+        """
+        Runs the pipeline until the frame source is exhausted and every frame has passed all stages.
+
+        Parameters:
+        - frames: Async iterable (or iterable) of (path, mtime_ns, image) tuples.
+        """
+        loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.executor_workers, thread_name_prefix="RuntimePipeline")
+        match_queue = asyncio.Queue(self.match_queue_depth)
+        extract_queue = asyncio.Queue(self.extract_queue_depth)
+        status_queue = asyncio.Queue(self.status_queue_depth)
+
+        stages = [
+            (match_queue, [asyncio.create_task(self.stage_worker(match_queue, extract_queue, self.match_frame, loop))
+                           for _ in range(self.match_concurrency)]),
+            (extract_queue, [asyncio.create_task(self.stage_worker(extract_queue, status_queue,
+                                                                   self.extract_parameters, loop))
+                             for _ in range(self.extract_concurrency)]),
+            (status_queue, [asyncio.create_task(self.stage_worker(status_queue, None, self.evaluate_status, loop))
+                            for _ in range(self.status_concurrency)]),
+        ]
+        try:
+            await self.ingest(frames, match_queue)
+            # Drain the stages front to back, then stop their workers
+            for queue, workers in stages:
+                await queue.join()
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+        finally:
+            for _, workers in stages:
+                for worker in workers:
+                    worker.cancel()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def ingest(self, frames, match_queue):
+        if hasattr(frames, "__aiter__"):
+            async for path, mtime_ns, image in frames:
+                await self.put_frame(match_queue, path, mtime_ns, image)
+        else:
+            for path, mtime_ns, image in frames:
+                await self.put_frame(match_queue, path, mtime_ns, image)
+
+    async def put_frame(self, match_queue, path, mtime_ns, image):
+        self.stats["ingested"] += 1
+        item = {"path": path, "mtime_ns": mtime_ns, "image": image, "start": time.perf_counter()}
+        await match_queue.put(item)
+
+    async def stage_worker(self, input_queue, output_queue, process, loop):
+        """
+        Takes frames from input_queue, processes them and passes them to output_queue. A frame whose processing
+        fails is counted and dropped, the worker continues with the next one.
+        """
+        while True:
+            item = await input_queue.get()
+            try:
+                item = await process(item, loop)
+                if item is not None and output_queue is not None:
+                    await output_queue.put(item)
+            except Exception as e:
+                self.stats["errors"] += 1
+                # stderr, so the errors stay visible when stdout carries the results or is silenced
+                print(f"Error processing {item.get('path')}: {e}", file=sys.stderr)
+            finally:
+                input_queue.task_done()
+
+    async def match_frame(self, item, loop):
+        match_values, temp_img_id = await loop.run_in_executor(
+            self.executor, self.session.match, item["image"]
+        )
+        if temp_img_id == -1 and isinstance(match_values, str):
+            self.stats["blank"] += 1
+            item.update(temp_img_id=None, match_values=None, blank_kind=match_values)
+        elif temp_img_id == -1:
+            self.stats["unmatched"] += 1
+            item.update(temp_img_id=None, match_values=None, blank_kind=None)
+        else:
+            self.stats["matched"] += 1
+            item.update(temp_img_id=temp_img_id, match_values=match_values, blank_kind=None)
+        return item
+
+    async def extract_parameters(self, item, loop):
+        item["parameters"] = {}
+        if item["temp_img_id"] is None:
+            return item
+        temp_img_data = self.matcher.mde_config_data.get("images", {}).get(item["temp_img_id"], {})
+        parameters = [parameter for parameter in temp_img_data.get("parameters", {}).values() if "name" in parameter]
+        if not parameters:
+            return item
+        # All parameter regions of the frame are cropped and preprocessed in one call, then read concurrently
+        filtered_crops = await loop.run_in_executor(
+            self.executor, self.preprocess_parameters, item["image"], temp_img_data.get("size"), parameters
+        )
+        tasks = {
+            parameter["name"]: loop.run_in_executor(self.executor, self.read_parameter, filtered_crop, parameter)
+            for parameter, filtered_crop in zip(parameters, filtered_crops)
+        }
+        values = await asyncio.gather(*tasks.values())
+        item["parameters"] = dict(zip(tasks, values))
+        return item
+
+    @staticmethod
+    def preprocess_parameters(image, size, parameters):
+        """
+        Crops the parameter regions (template coordinates) from the frame and preprocesses them for OCR.
+
+        Returns:
+        - list: The preprocessed crop of each parameter, None for regions that could not be cropped.
+        """
+        rects = []
+        for parameter in parameters:
+            position = parameter.get("position", {})
+            rects.append((int(position.get("x1", 0)), int(position.get("y1", 0)),
+                          int(round(position.get("x2", 0))), int(round(position.get("y2", 0)))))
+        return prepare_crops_for_ocr(image, rects, new_size=size or None)
+
+    def read_parameter(self, filtered_crop, parameter):
+        """
+        Reads a preprocessed parameter region with ocr_fn.
+
+        Returns:
+        - str or None: The recognised text, or None without ocr_fn or if the region could not be cropped.
+        """
+        if filtered_crop is None or self.ocr_fn is None:
+            return None
+        return self.ocr_fn(filtered_crop, parameter["name"])
+
+    async def evaluate_status(self, item, loop):
+        status = None
+        if item["temp_img_id"] is not None:
+            temp_img_data = self.matcher.mde_config_data.get("images", {}).get(item["temp_img_id"], {})
+            machine_status_conditions = temp_img_data.get("machine_status_conditions", [])
+            # Conditions on unread parameters would compare against empty values, so no status is reported then
+            unread = any(item["parameters"].get(name) is None
+                         for name in get_condition_parameters(machine_status_conditions))
+            if self.ocr_fn is None or unread:
+                self.stats["status_unknown"] += 1
+            else:
+                status = evaluate_machine_status(machine_status_conditions, item["parameters"])
+        self.stats["evaluated"] += 1
+        result = {
+            "path": item["path"],
+            "mtime_ns": item["mtime_ns"],
+            "temp_img_id": item["temp_img_id"],
+            "match_values": item["match_values"],
+            "blank_kind": item["blank_kind"],
+            "parameters": item["parameters"],
+            "status": status,
+            "latency_ms": (time.perf_counter() - item["start"]) * 1000,
+        }
+        if self.on_result is not None:
+            self.on_result(result)
+        return None
+
+
+def main():
+    from config_manager import AppConfigManager
+    from frame_stream import FrameStream
+    from pattern_detection_v001 import ImageMatcher
+
+    parser = argparse.ArgumentParser(description="Match the frames of a capture directory and evaluate the machine status.")
+    parser.add_argument("capture_dir", help="Directory the capture device writes its frames to.")
+    parser.add_argument("--app-config", default="config.ini")
+    parser.add_argument("--config-dir", default="ConfigFiles")
+    parser.add_argument("--config-file", default="mde_config.json")
+    parser.add_argument("--templates-dir", default="templates")
+    parser.add_argument("--include-existing", action="store_true", help="Also process the frames already present.")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    args = parser.parse_args()
+
+    config_manager = AppConfigManager(args.app_config)
+    # The matcher prints its match values, keep stdout for the results. The stream runs indefinitely, so the prints
+    # are discarded instead of being collected
+    matcher_output = open(os.devnull, "w")
+    with contextlib.redirect_stdout(matcher_output):
+        matcher = ImageMatcher(args.config_dir, args.config_file, args.templates_dir,
+                               **config_manager.get_matcher_settings())
+
+    def print_result(result):
+        sys.__stdout__.write(json.dumps(result, ensure_ascii=False) + "\n")
+        sys.__stdout__.flush()
+
+    # No OCR engine is part of this application, so only the template is reported, without parameters and status
+    pipeline = RuntimePipeline(matcher, on_result=print_result, session_settings=config_manager.get_session_settings(),
+                               **config_manager.get_pipeline_settings())
+    stream = FrameStream(args.capture_dir, poll_interval=args.poll_interval, include_existing=args.include_existing)
+    try:
+        with stream, contextlib.redirect_stdout(matcher_output):
+            asyncio.run(pipeline.run(stream))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        matcher.close()
+        matcher_output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+''' This module compiles a decision tree over the templates of mde_config.json, used by the ImageMatcher to classify a
+frame with a few feature tests instead of testing every feature of every template. '''
+
+
+def compile_decision_tree(template_ids, feature_tests, outcomes):
+    """
+    Compiles a decision tree over templates. Every inner node tests one template feature on the frame, the two
+    branches hold the templates whose screens pass respectively fail that test. At every node the test that splits the
+    remaining templates most evenly is chosen, so a frame is classified with about log2(templates) feature tests.
+
+    Parameters:
+    - template_ids (list): IDs of the templates to classify, in configuration order.
+    - feature_tests (list): (temp_img_id, merkma_id) feature tests available at the nodes.
+    - outcomes (dict): {(temp_img_id, merkma_id): {template_id: bool}}, the outcome of each feature test on the
+      screen of each template (its template image).
+
+    Returns:
+    - dict: The root node. Inner nodes are {"test": (temp_img_id, merkma_id), "pass": node, "fail": node},
+      leaves are {"candidates": [template IDs in configuration order]}.
+    """
+    return _build_node(list(template_ids), list(feature_tests), outcomes)
+
+
+def _build_node(candidates, feature_tests, outcomes):
+    if len(candidates) <= 1:
+        return {"candidates": candidates}
+
+    # Choose the test with the most even split; tests that do not split the candidates are useless here
+    best_test, best_split, best_size = None, None, len(candidates)
+    for feature_test in feature_tests:
+        test_outcomes = outcomes.get(feature_test, {})
+        passed = [template_id for template_id in candidates if test_outcomes.get(template_id, False)]
+        failed = [template_id for template_id in candidates if not test_outcomes.get(template_id, False)]
+        if not passed or not failed:
+            continue
+        larger_branch = max(len(passed), len(failed))
+        if larger_branch < best_size:
+            best_test, best_split, best_size = feature_test, (passed, failed), larger_branch
+
+    if best_test is None:
+        # No test separates these templates, they are verified one after another
+        return {"candidates": candidates}
+
+    remaining_tests = [feature_test for feature_test in feature_tests if feature_test != best_test]
+    passed, failed = best_split
+    return {
+        "test": best_test,
+        "pass": _build_node(passed, remaining_tests, outcomes),
+        "fail": _build_node(failed, remaining_tests, outcomes),
+    }
+
+
+def classify(tree, run_test):
+    """
+    Walks the decision tree for one frame.
+
+    Parameters:
+    - tree (dict): The root node returned by compile_decision_tree.
+    - run_test (callable): run_test((temp_img_id, merkma_id)) returns True if the feature matches the frame,
+      False if not and None if the test could not be run.
+
+    Returns:
+    - tuple: (candidates, tests_run). candidates is the list of templates of the reached leaf, or None if a test
+      could not be run.
+    """
+    node = tree
+    tests_run = 0
+    while "test" in node:
+        outcome = run_test(node["test"])
+        tests_run += 1
+        if outcome is None:
+            return None, tests_run
+        node = node["pass"] if outcome else node["fail"]
+    return node["candidates"], tests_run
+
+
+def tree_depth(tree):
+    """
+    Returns the largest number of feature tests on a path from the root to a leaf.
+    """
+    if "test" not in tree:
+        return 0
+    return 1 + max(tree_depth(tree["pass"]), tree_depth(tree["fail"]))
@@ -0,0 +1,103 @@
+''' This module stores the filtered feature crops of the templates on disk, one .npz file per template image, so the
+ImageMatcher does not have to load and filter every template again when it is re-created. '''
+import json
+import os
+import numpy as np
+
+
+class TemplateFeatureCache:
+    """
+    On-disk cache of the filtered feature crops of the template images.
+
+    A cache file is only used if the template image (modification time and file size), the feature rectangles and the
+    preprocessing version are the same as when it was written, otherwise the template is filtered again.
+    """
+    def __init__(self, cache_dir, preprocessing_version):
+        """
+        Parameters:
+        - cache_dir (str): Directory of the cache files, created if it does not exist.
+        - preprocessing_version (str): Identifies the filter and its parameters. Changing it invalidates all files.
+        """
+        self.cache_dir = cache_dir
+        self.preprocessing_version = preprocessing_version
+        self.stats = {"hits": 0, "misses": 0}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_cache_file_path(self, temp_img_path):
+        return os.path.join(self.cache_dir, os.path.basename(temp_img_path) + ".npz")
+
+    def get_cache_key(self, temp_img_path, rects):
+        """
+        Returns the key a cache file must have to be valid, or None if the template image does not exist.
+        """
+        try:
+            stat = os.stat(temp_img_path)
+        except OSError:
+            return None
+        return {
+            "preprocessing": self.preprocessing_version,
+            "mtime_ns": stat.st_mtime_ns,
+            "file_size": stat.st_size,
+            "rects": [list(rect) for rect in rects],
+        }
+
+    def load(self, temp_img_path, rects):
+        """
+        Loads the filtered feature crops of a template.
+
+        Parameters:
+        - temp_img_path (str): Path of the template image.
+        - rects (list): Feature rectangles (x1, y1, x2, y2) in the order they were saved.
+
+        Returns:
+        - list or None: The filtered crop of each rectangle (None for crops that could not be filtered), or None if
+          there is no valid cache file.
+        """
+        cache_file_path = self.get_cache_file_path(temp_img_path)
+        key = self.get_cache_key(temp_img_path, rects)
+        if key is None or not os.path.exists(cache_file_path):
+            self.stats["misses"] += 1
+            return None
+        try:
+            with np.load(cache_file_path, allow_pickle=False) as data:
+                if json.loads(str(data["key"])) != key:
+                    self.stats["misses"] += 1
+                    return None
+                crops = [data[f"feature_{i}"] if f"feature_{i}" in data.files else None for i in range(len(rects))]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading template feature cache {cache_file_path}: {e}")
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return crops
+
+    def save(self, temp_img_path, rects, crops):
+        """
+        Saves the filtered feature crops of a template.
+
+        Parameters:
+        - temp_img_path (str): Path of the template image.
+        - rects (list): Feature rectangles (x1, y1, x2, y2).
+        - crops (list): The filtered crop of each rectangle, None for crops that could not be filtered.
+        """
+        key = self.get_cache_key(temp_img_path, rects)
+        if key is None:
+            return
+        arrays = {f"feature_{i}": crop for i, crop in enumerate(crops) if crop is not None}
+        cache_file_path = self.get_cache_file_path(temp_img_path)
+        # Write to a temporary file first, so a concurrent reader never sees a half written cache file
+        temp_file_path = cache_file_path + f".{os.getpid()}.tmp"
+        try:
+            with open(temp_file_path, "wb") as file:
+                np.savez(file, key=np.array(json.dumps(key)), **arrays)
+            os.replace(temp_file_path, cache_file_path)
+        except OSError as e:
+            print(f"Error saving template feature cache {cache_file_path}: {e}")
+
+    def clear(self):
+        """
+        Deletes all cache files.
+        """
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".npz"):
+                os.remove(os.path.join(self.cache_dir, file_name))
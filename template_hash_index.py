@@ -0,0 +1,145 @@
+''' This module keeps a perceptual hash (dHash) of every template image, used by the ImageMatcher to shortlist the
+templates closest to a frame before any feature is matched. The index is persisted next to mde_config.json. '''
+import json
+import os
+import numpy as np
+from Image_functions_v001 import cv2, dhash_image
+
+
+class TemplateHashIndex:
+    """
+    In-memory index of template hashes, queried by Hamming distance.
+
+    The index file stores for every template the image path, its modification time and the hex encoded hash, so a
+    template is only hashed again when its image changed.
+    """
+    def __init__(self, index_file_path, hash_size=16):
+        """
+        Parameters:
+        - index_file_path (str): Path of the JSON file the index is persisted to.
+        - hash_size (int): Rows and bits per row of the dHash, see dhash_image.
+        """
+        self.index_file_path = index_file_path
+        self.hash_size = hash_size
+        self.entries = {}
+        self.hashes = {}
+        self.load()
+
+    def load(self):
+        """
+        Loads the persisted index. A missing or unreadable file, or one written with another hash size, gives an
+        empty index.
+        """
+        self.entries = {}
+        self.hashes = {}
+        if not os.path.exists(self.index_file_path):
+            return
+        try:
+            with open(self.index_file_path, "r", encoding="utf-8") as file:
+                data = json.load(file)
+        except (OSError, ValueError) as e:
+            print(f"Error loading template hash index: {e}")
+            return
+        if data.get("hash_size") != self.hash_size:
+            return
+        for temp_img_id, entry in data.get("templates", {}).items():
+            self.entries[temp_img_id] = entry
+            self.hashes[temp_img_id] = np.frombuffer(bytes.fromhex(entry["hash"]), dtype=np.uint8)
+
+    def save(self):
+        """
+        Writes the index to the index file.
+        """
+        try:
+            with open(self.index_file_path, "w", encoding="utf-8") as file:
+                json.dump({"hash_size": self.hash_size, "templates": self.entries}, file, indent=2)
+        except OSError as e:
+            print(f"Error saving template hash index: {e}")
+
+    def add(self, temp_img_id, img_path, img=None):
+        """
+        Hashes a template image and stores it in the index.
+
+        Parameters:
+        - temp_img_id (str): The template ID.
+        - img_path (str): Path of the template image.
+        - img (ndarray, optional): The already loaded template image.
+
+        Returns:
+        - bool: True if the template was hashed, False if its image could not be read.
+        """
+        if img is None:
+            img = cv2.imread(img_path)
+        img_hash = dhash_image(img, self.hash_size) if img is not None else None
+        if img_hash is None:
+            self.remove(temp_img_id)
+            return False
+        self.entries[temp_img_id] = {
+            "path": os.path.basename(img_path),
+            "mtime": os.path.getmtime(img_path) if os.path.exists(img_path) else None,
+            "hash": img_hash.tobytes().hex(),
+        }
+        self.hashes[temp_img_id] = img_hash
+        return True
+
+    def remove(self, temp_img_id):
+        """
+        Removes a template from the index.
+        """
+        self.entries.pop(temp_img_id, None)
+        self.hashes.pop(temp_img_id, None)
+
+    def update(self, template_paths, templates_dir):
+        """
+        Brings the index in line with the templates of the configuration: new or changed template images are hashed,
+        templates that no longer exist are removed. The index file is rewritten if anything changed.
+
+        Parameters:
+        - template_paths (dict): {temp_img_id: image file name} of all templates.
+        - templates_dir (str): Directory of the template images.
+
+        Returns:
+        - int: Number of templates that were hashed.
+        """
+        changed = False
+        hashed = 0
+        for temp_img_id in list(self.entries):
+            if temp_img_id not in template_paths:
+                self.remove(temp_img_id)
+                changed = True
+
+        for temp_img_id, path in template_paths.items():
+            img_path = os.path.join(templates_dir, path)
+            mtime = os.path.getmtime(img_path) if os.path.exists(img_path) else None
+            entry = self.entries.get(temp_img_id)
+            if entry is not None and entry["path"] == os.path.basename(path) and entry["mtime"] == mtime:
+                continue
+            if self.add(temp_img_id, img_path):
+                hashed += 1
+            changed = True
+
+        if changed:
+            self.save()
+        return hashed
+
+    def query(self, frame_hash, k, template_ids=None):
+        """
+        Returns the k templates closest to a frame hash.
+
+        Parameters:
+        - frame_hash (ndarray): The bit-packed hash of the frame, see dhash_image.
+        - k (int): Number of templates to return.
+        - template_ids (list, optional): Order of the templates, used to break ties. Defaults to the index order.
+
+        Returns:
+        - list: [(temp_img_id, hamming_distance), ...] sorted by distance.
+        """
+        if template_ids is None:
+            template_ids = list(self.hashes)
+        template_ids = [temp_img_id for temp_img_id in template_ids if temp_img_id in self.hashes]
+        if not template_ids:
+            return []
+        hashes = np.stack([self.hashes[temp_img_id] for temp_img_id in template_ids])
+        distances = np.bitwise_count(np.bitwise_xor(hashes, frame_hash)).sum(axis=1)
+        order = np.argsort(distances, kind="stable")[:k]
+        return [(template_ids[i], int(distances[i])) for i in order]
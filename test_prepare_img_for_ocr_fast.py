@@ -0,0 +1,168 @@
+''' Equivalence tests of the fast preprocessing paths: prepare_img_for_ocr_fast and the batch API
+prepare_crops_for_ocr must return exactly the output of prepare_img_for_ocr. '''
+import json
+import os
+
+import numpy as np
+import pytest
+from Image_functions_v001 import (cv2, BufferPool, prepare_img_for_ocr, prepare_img_for_ocr_fast,
+                                  prepare_crops_for_ocr, resize_crop_cv2)
+
+CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ConfigFiles")
+
+
+def load_templates():
+    """
+    Returns (temp_img_id, template image, [(x1, y1, x2, y2), ...]) of every template with its feature and parameter
+    regions.
+    """
+    with open(os.path.join(CONFIG_DIR, "mde_config.json"), encoding="utf-8") as file:
+        mde_config_data = json.load(file)
+    templates = []
+    for temp_img_id, temp_img_data in mde_config_data.get("images", {}).items():
+        temp_img = cv2.imread(os.path.join(CONFIG_DIR, "templates", temp_img_data.get("path", "")))
+        if temp_img is None:
+            continue
+        rects = []
+        for category in ("features", "parameters"):
+            for item in temp_img_data.get(category, {}).values():
+                position = item.get("position", {})
+                rects.append((int(position.get("x1", 0)), int(position.get("y1", 0)),
+                              int(position.get("x2", 0)), int(position.get("y2", 0))))
+        templates.append((temp_img_id, temp_img, rects))
+    return templates
+
+
+TEMPLATES = load_templates()
+
+
+def special_crops():
+    """
+    Crops at the edge cases of the preprocessing: no text, all black, text of at most 2 pixels, grayscale input.
+    """
+    white = np.full((20, 40, 3), 255, dtype=np.uint8)
+    black = np.zeros((20, 40, 3), dtype=np.uint8)
+    gray = np.full((20, 40, 3), 128, dtype=np.uint8)
+    dot = white.copy()
+    dot[10, 20] = 0
+    thin_line = white.copy()
+    thin_line[5:7, 3:30] = 0
+    two_by_two = white.copy()
+    two_by_two[8:10, 8:10] = 0
+    three_by_three = white.copy()
+    three_by_three[8:11, 8:11] = 0
+    white_text_on_black = black.copy()
+    cv2.putText(white_text_on_black, "42", (2, 16), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+    one_pixel = np.zeros((1, 1, 3), dtype=np.uint8)
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (15, 25, 3), dtype=np.uint8)
+    return {
+        "white": white, "black": black, "gray": gray, "dot": dot, "thin line": thin_line,
+        "2x2 text": two_by_two, "3x3 text": three_by_three, "white text on black": white_text_on_black,
+        "1x1": one_pixel, "noise": noise, "grayscale noise": cv2.cvtColor(noise, cv2.COLOR_BGR2GRAY),
+        "grayscale text": cv2.cvtColor(white_text_on_black, cv2.COLOR_BGR2GRAY),
+    }
+
+
+def test_templates_are_available():
+    assert TEMPLATES, "No template images found in ConfigFiles"
+
+
+@pytest.mark.parametrize("temp_img_id, temp_img, rects", TEMPLATES, ids=[template[0] for template in TEMPLATES])
+def test_fast_path_matches_reference_on_template_crops(temp_img_id, temp_img, rects):
+    for x1, y1, x2, y2 in rects:
+        crop = temp_img[y1:y2, x1:x2]
+        if crop.size == 0:
+            continue
+        np.testing.assert_array_equal(prepare_img_for_ocr_fast(crop), prepare_img_for_ocr(crop),
+                                      err_msg=f"template {temp_img_id} region {(x1, y1, x2, y2)}")
+
+
+@pytest.mark.parametrize("name", list(special_crops()))
+def test_fast_path_matches_reference_on_special_crops(name):
+    crop = special_crops()[name]
+    np.testing.assert_array_equal(prepare_img_for_ocr_fast(crop), prepare_img_for_ocr(crop))
+
+
+def test_fast_path_with_buffers_matches_reference():
+    pool = BufferPool()
+    for _ in range(2):
+        # The second round runs on reused buffers that still hold the first round's images
+        for crop in special_crops().values():
+            lease = pool.lease()
+            np.testing.assert_array_equal(prepare_img_for_ocr_fast(crop, buffers=lease), prepare_img_for_ocr(crop))
+            lease.release()
+    assert pool.stats["reuses"] > 0
+
+
+@pytest.mark.parametrize("temp_img_id, temp_img, rects", TEMPLATES, ids=[template[0] for template in TEMPLATES])
+def test_batch_matches_reference_on_template_regions(temp_img_id, temp_img, rects):
+    filtered_crops = prepare_crops_for_ocr(temp_img, rects)
+    assert len(filtered_crops) == len(rects)
+    for (x1, y1, x2, y2), filtered_crop in zip(rects, filtered_crops):
+        crop = temp_img[y1:y2, x1:x2]
+        if crop.size == 0:
+            assert filtered_crop is None
+            continue
+        np.testing.assert_array_equal(filtered_crop, prepare_img_for_ocr(crop),
+                                      err_msg=f"template {temp_img_id} region {(x1, y1, x2, y2)}")
+
+
+def test_batch_matches_reference_on_equal_shapes_and_special_crops():
+    # Many crops of one shape go through the stacked path, including blank, black and tiny-text crops
+    temp_img = TEMPLATES[0][1]
+    frame = temp_img.copy()
+    crops = [crop for crop in special_crops().values() if crop.shape == (20, 40, 3)]
+    rects = []
+    for index, crop in enumerate(crops):
+        x1, y1 = 10 + index * 45, 10
+        frame[y1:y1 + 20, x1:x1 + 40] = crop
+        rects.append((x1, y1, x1 + 40, y1 + 20))
+    rng = np.random.default_rng(1)
+    height, width = frame.shape[:2]
+    for x1, y1 in zip(rng.integers(0, width - 40, 20), rng.integers(0, height - 20, 20)):
+        rects.append((int(x1), int(y1), int(x1) + 40, int(y1) + 20))
+    rects.append((5, 5, 5, 9))  # empty region
+
+    pool = BufferPool()
+    for buffers in (None, pool.lease()):
+        for image in (frame, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)):
+            filtered_crops = prepare_crops_for_ocr(image, rects, buffers=buffers)
+            for (x1, y1, x2, y2), filtered_crop in zip(rects, filtered_crops):
+                crop = image[y1:y2, x1:x2]
+                if crop.size == 0:
+                    assert filtered_crop is None
+                    continue
+                np.testing.assert_array_equal(filtered_crop, prepare_img_for_ocr(crop),
+                                              err_msg=f"region {(x1, y1, x2, y2)}")
+
+
+def test_batch_with_new_size_matches_reference():
+    _, temp_img, rects = TEMPLATES[0]
+    height, width = temp_img.shape[:2]
+    frame = cv2.resize(temp_img, (width * 3 // 2, height * 3 // 2))
+    size = {"width": width, "height": height}
+    filtered_crops = prepare_crops_for_ocr(frame, rects, new_size=size)
+    for (x1, y1, x2, y2), filtered_crop in zip(rects, filtered_crops):
+        crop = resize_crop_cv2(frame, size, x1, y1, x2, y2)
+        if crop is None or crop.size == 0:
+            assert filtered_crop is None
+            continue
+        np.testing.assert_array_equal(filtered_crop, prepare_img_for_ocr(crop))
+
+
+def test_batch_with_new_size_scaling_up_matches_full_resize():
+    # Frames smaller than the template are resized fully before cropping, so the crops are exact
+    _, temp_img, rects = TEMPLATES[0]
+    height, width = temp_img.shape[:2]
+    frame = cv2.resize(temp_img, (800, 600))
+    resized = cv2.resize(frame, (width, height))
+    size = {"width": width, "height": height}
+    filtered_crops = prepare_crops_for_ocr(frame, rects, new_size=size)
+    for (x1, y1, x2, y2), filtered_crop in zip(rects, filtered_crops):
+        crop = resized[y1:y2, x1:x2]
+        np.testing.assert_array_equal(resize_crop_cv2(frame, size, x1, y1, x2, y2), crop)
+        if crop.size == 0:
+            assert filtered_crop is None
+            continue
+        np.testing.assert_array_equal(filtered_crop, prepare_img_for_ocr(crop))
@@ -33,7 +33,7 @@ class ConfigurationTool:
     # Initialization and UI Setup
     # ----------------------------------
     def __init__(self, mde_config_dir, mde_config_file_name,
-                 templates_dir_name, choices_dict):
+                 templates_dir_name, choices_dict, matcher_settings=None):
         """
         Initializes the ConfigurationTool application.
 
@@ -42,6 +42,7 @@ class ConfigurationTool:
         - mde_config_file_name (str): Name of the configuration file.
         - templates_dir_name (str): Name of the directory containing image templates.
         - choices_dict (dict): Dictionary of choices for machine statuses.
+        - matcher_settings (dict, optional): Keyword arguments for the ImageMatcher from the [Matcher] section of config.ini.
         """
 
         # Initialize configuration paths and data
@@ -49,6 +50,7 @@ class ConfigurationTool:
         self.mde_config_file_name = mde_config_file_name
         self.templates_dir_name = templates_dir_name
         self.choices_dict = choices_dict
+        self.matcher_settings = matcher_settings or {}
         self.image_data = None
         self.selected_img_path = None  # Store the image path
         self.parametrs_suggestions_but_toggle = False
@@ -113,7 +115,8 @@ class ConfigurationTool:
             mde_config_dir=self.mde_config_dir,
             mde_config_file_name=self.mde_config_file_name,
             templates_dir_name=self.templates_dir_name,
-            config_tool=self
+            config_tool=self,
+            matcher_settings=self.matcher_settings
         )
        # self.but_functions.config_data = self.config_data  # Share config_data
       #  self.but_functions.config_data_lock = threading.Lock()
@@ -538,8 +541,10 @@ TIPS:
                 # Update status
                 self.update_status("Loading image...", "Step 2/4")
                 
-                # Open the image using PIL
-                self.original_image = Image.open(selected_img_path)
+                # Take the image decoded by browse_files from the cache instead of decoding the file again
+                self.original_image = self.but_functions.image_cache.get_pil_image(selected_img_path)
+                if self.original_image is None:
+                    raise ValueError(f"Could not read image: {selected_img_path}")
                 original_width, original_height = self.original_image.size  # Store original image size
 
                 # Get canvas dimensions